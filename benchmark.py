@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import io
+import json
+import platform
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import pymenu
+
+# First option id used by benchmark menus, clear of the reserved option ids
+BENCH_ID_BASE = 10000
+
+SIZES       = [10, 100, 1000, 10000, 100000]
+QUICK_SIZES = [10, 100, 1000]
+
+class NullWriter(object):
+    """Discards menu output so benchmarks measure the menu rather than the terminal"""
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+def noop():
+    pass
+
+def frame_depth():
+    """
+    Counts the frames on the Python stack of the caller
+    :return:                           A stack depth
+    """
+
+    depth = 0
+    frame = sys._getframe(1)
+    while frame:
+        depth += 1
+        frame  = frame.f_back
+
+    return depth
+
+def scripted(selections, fx):
+    """
+    Calls a function with stdin replaced by a list of selections and stdout discarded
+    :param selections:                 A list of selections to feed to stdin
+    :param fx:                         The function to call
+    :return:                           The return value of the function
+    """
+
+    stdin, stdout = sys.stdin, sys.stdout
+    sys.stdin  = io.StringIO("\n".join(selections) + "\n")
+    sys.stdout = NullWriter()
+    try:
+        return fx()
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
+
+def measure(fx, repeat=1):
+    """
+    Times a function, keeping the best of several runs, then runs it once
+    more under tracemalloc to find its peak memory
+    :param fx:                         The function to measure, called with no arguments
+    :param repeat:                     The number of timed runs
+    :return:                           A tuple of the best time in seconds, the peak
+                                       memory in bytes and the last return value
+    """
+
+    best = None
+    for _ in range(repeat):
+        start  = time.perf_counter()
+        result = fx()
+        took   = time.perf_counter() - start
+        best   = took if best is None else min(best, took)
+
+    tracemalloc.start()
+    try:
+        fx()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return best, peak, result
+
+def make_options(n, fx=noop):
+    return [pymenu.MenuOption(BENCH_ID_BASE + i, "[o%d] option %d" % (i, i), ["o%d" % i], fx)
+            for i in range(n)]
+
+def bench_build(n, repeat):
+    """Builds a menu of n options one add_option call at a time"""
+
+    def build():
+        menu = pymenu.Menu()
+        for i in range(n):
+            menu.add_option(BENCH_ID_BASE + i, "[o%d] option %d" % (i, i), ["o%d" % i], noop)
+        return menu
+
+    took, peak, _ = measure(build, repeat)
+    return {"seconds": took, "per_option_us": took / n * 1e6, "peak_bytes": peak}
+
+def bench_bulk(n, repeat):
+    """Builds a menu of n options with a single add_options call"""
+
+    opts = make_options(n)
+
+    def build():
+        menu = pymenu.Menu()
+        menu.add_options(list(opts))
+        return menu
+
+    took, peak, _ = measure(build, repeat)
+    return {"seconds": took, "per_option_us": took / n * 1e6, "peak_bytes": peak}
+
+def bench_dispatch(n, selections, repeat, metrics=False):
+    """Runs scripted selections against a menu of n options through Menu.run"""
+
+    menu = pymenu.Menu()
+    menu.add_options(make_options(n))
+    if metrics:
+        pymenu.MenuMetrics().attach(menu)
+    script = ["o%d" % ((i * 7919) % n) for i in range(selections)]
+
+    took, peak, _ = measure(lambda: scripted(script, menu.run), repeat)
+    return {"seconds": took, "per_selection_us": took / selections * 1e6, "peak_bytes": peak,
+            "dispatch_builds": menu.get_dispatch_builds()}
+
+def build_chain(levels, leaf_fx):
+    root = menu = pymenu.Menu(prompt="L1>")
+    for lvl in range(2, levels + 1):
+        child = pymenu.Menu(prompt="L%d>" % lvl, lvl=lvl, add_back=True)
+        menu.add_option(1, "[d]own", ["d"], child.run)
+        menu.add_child_menu(child)
+        menu = child
+    menu.add_option(1, "[p]robe", ["p"], leaf_fx)
+    return root
+
+def bench_deep(levels, repeat):
+    """Walks down a chain of menus levels deep and back up again"""
+
+    depths = []
+
+    def probe():
+        depths.append(frame_depth())
+
+    build_took, build_peak, root = measure(lambda: build_chain(levels, probe), repeat)
+    script = ["d"] * (levels - 1) + ["p"] + ["b"] * (levels - 1)
+    took, peak, _ = measure(lambda: scripted(script, root.run), repeat)
+
+    return {"build_seconds": build_took, "build_peak_bytes": build_peak, "seconds": took,
+            "per_hop_us": took / (2 * (levels - 1)) * 1e6, "peak_bytes": peak,
+            "max_stack_depth": max(depths)}
+
+def bench_paths(levels, selections, repeat):
+    """Jumps straight to the bottom of a chain of menus levels deep by path"""
+
+    root = build_chain(levels, noop)
+    path = pymenu.PATH_SEP + pymenu.PATH_SEP.join(["d"] * (levels - 1) + ["p"])
+
+    index_took, index_peak, _ = measure(lambda: pymenu._build_path_index(root), repeat)
+    took, peak, _ = measure(lambda: scripted([path] * selections, root.run), repeat)
+
+    return {"index_seconds": index_took, "index_peak_bytes": index_peak, "seconds": took,
+            "per_selection_us": took / selections * 1e6, "peak_bytes": peak}
+
+def bench_move(nodes, fanout, repeat):
+    """Moves a subtree of a tree of nodes menus below another branch and back to the root"""
+
+    def build():
+        root  = pymenu.Menu(prompt="T>")
+        queue = collections.deque([root])
+        count = 1
+        while count < nodes:
+            parent = queue.popleft()
+            for _ in range(min(fanout, nodes - count)):
+                child = pymenu.Menu(prompt="T>")
+                parent.graft(child)
+                queue.append(child)
+                count += 1
+        return root
+
+    build_took, build_peak, root = measure(build, 1)
+    subtree = root.get_child_menus()[0]
+    target  = root.get_child_menus()[-1]
+    while target.get_child_menus():
+        target = target.get_child_menus()[-1]
+
+    def move():
+        subtree.move(target)
+        subtree.move(root)
+
+    took, peak, _ = measure(move, repeat)
+
+    # Moving the subtree below its own deepest menu is refused after walking up from that menu
+    leaf = subtree
+    while leaf.get_child_menus():
+        leaf = leaf.get_child_menus()[-1]
+    start = time.perf_counter()
+    try:
+        subtree.move(leaf)
+    except pymenu.MenuEditError:
+        pass
+    cycle_took = time.perf_counter() - start
+
+    moved = sum(1 for _ in pymenu._iter_menus(subtree))
+    for menu in pymenu._iter_menus(root):
+        for child in menu.get_child_menus():
+            assert child.get_level() == menu.get_level() + 1
+
+    return {"build_seconds": build_took, "build_peak_bytes": build_peak, "seconds": took,
+            "moved_menus": moved, "per_menu_us": took / (2 * moved) * 1e6, "peak_bytes": peak,
+            "cycle_check_us": cycle_took * 1e6}
+
+def bench_snapshot(menus, options, repeat):
+    """Builds a tree of menus with options each one add_option call at a time, then compiles and loads it"""
+
+    def build():
+        root = pymenu.Menu(prompt="S>")
+        for i in range(menus):
+            child = pymenu.Menu(prompt="S%d>" % i, lvl=2, add_back=True)
+            for j in range(options):
+                child.add_option(BENCH_ID_BASE + j, "[o%d] option %d" % (j, j), ["o%d" % j], noop)
+            root.add_option(i + 1, "[m%d] menu %d" % (i, i), ["m%d" % i], child.run)
+            root.add_child_menu(child)
+        return root
+
+    build_took, build_peak, root = measure(build, repeat)
+    compile_took, _, snapshot = measure(lambda: pymenu.compile_menu(root), repeat)
+    took, peak, loaded = measure(lambda: pymenu.load_compiled_menu(snapshot), repeat)
+    assert len(loaded.get_paths()) == len(root.get_paths())
+
+    return {"build_seconds": build_took, "build_peak_bytes": build_peak, "compile_seconds": compile_took,
+            "seconds": took, "peak_bytes": peak, "snapshot_bytes": len(snapshot),
+            "speedup": build_took / took}
+
+def bench_threads(threads, calls, wait):
+    """
+    Dispatches selections and paths against one shared menu tree from
+    several threads at once, checking every result. Option functions sleep
+    for wait seconds, standing in for a call to another service.
+    """
+
+    def work():
+        if wait:
+            time.sleep(wait)
+        return threading.get_ident()
+
+    leaf = pymenu.Menu(prompt="Leaf>", lvl=2, add_back=True)
+    leaf.add_options(make_options(1000, work))
+    root = pymenu.Menu(prompt="Root>")
+    root.add_option(1, "[l]eaf", ["l", "leaf"], leaf.run)
+    root.add_child_menu(leaf)
+
+    errors  = []
+    barrier = threading.Barrier(threads + 1)
+
+    def run():
+        ident = threading.get_ident()
+        barrier.wait()
+        for i in range(calls):
+            sel = "o%d" % ((i * 7919) % 1000)
+            try:
+                res = pymenu.dispatch(root, "leaf/" + sel)
+                if res.option is not leaf.get_option_by_selector(sel) or res.menu is not leaf or res.result != ident:
+                    errors.append(sel)
+                if pymenu.dispatch(leaf, "b").menu is not root:
+                    errors.append("b")
+            except pymenu.MenuError as e:
+                errors.append(e)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    took = time.perf_counter() - start
+
+    return {"seconds": took, "dispatches": 2 * threads * calls,
+            "per_second": 2 * threads * calls / took, "errors": len(errors)}
+
+def example_tree(fx):
+    c_menu1 = pymenu.Menu(prompt="Interrogate>", lvl=2, add_back=True)
+    c_menu1.add_option(1, "[l]ist processes", ["l", "lp", "list"], fx)
+    c_menu1.add_option(2, "[n]etwork connections", ["n", "nc", "network"], fx)
+    c_menu2 = pymenu.Menu(prompt="Interrogate>", lvl=2, add_back=True)
+    c_menu2.add_option(1, "[d]ll list", ["d", "dll", "list"], fx)
+    r_menu = pymenu.Menu(prompt="Interrogate>")
+    r_menu.add_option(1, "[s]urvey target", ["s", "survey"], c_menu1.run)
+    r_menu.add_option(2, "[e]xamine process", ["e", "examine"], c_menu2.run)
+    r_menu.add_child_menu(c_menu1)
+    r_menu.add_child_menu(c_menu2)
+    return r_menu
+
+def bench_replay(sessions, cycles):
+    """Records a scripted session on the example.py tree, then replays it as many concurrent sessions"""
+
+    menu     = example_tree(noop)
+    recorder = pymenu.SessionRecorder()
+    recorder.attach(menu)
+    scripted(["s", "l", "n", "b", "e", "d", "b", "survey/list", "b", "e;d;b"] * cycles, menu.run)
+    recorder.detach()
+
+    replayer = pymenu.replay(pymenu.stub_menu(menu), recorder.get_transcripts(), sessions)
+    result   = replayer.as_dict()
+
+    return {"seconds": result["wall_time"], "selections": result["selections"],
+            "per_second": result["throughput"], "p50_us": result["latency"]["p50"] * 1e6,
+            "p99_us": result["latency"]["p99"] * 1e6, "divergences": result["divergences"]}
+
+def bench_navigation(cycles, repeat, chained=False):
+    """
+    Moves back and forth between a root menu and two child menus, as in
+    example.py, one selection per line or one chain of selections per line
+    """
+
+    depths = []
+
+    def probe():
+        depths.append(frame_depth())
+
+    r_menu = example_tree(probe)
+    script = ["s", "l", "b", "e", "d", "b"] * cycles
+    selections = len(script)
+    if chained:
+        script = [pymenu.CHAIN_SEP.join(script[i:i + 6]) for i in range(0, selections, 6)]
+    took, peak, _ = measure(lambda: scripted(script, r_menu.run), repeat)
+
+    return {"seconds": took, "per_selection_us": took / selections * 1e6, "peak_bytes": peak,
+            "min_stack_depth": min(depths), "max_stack_depth": max(depths)}
+
+def run_benchmarks(quick=False, repeat=3):
+    """
+    Runs every benchmark
+    :param quick:                      Uses smaller sizes
+    :param repeat:                     The number of timed runs for each benchmark
+    :return:                           A list of result dictionaries
+    """
+
+    sizes   = QUICK_SIZES if quick else SIZES
+    results = []
+
+    def record(name, params, metrics):
+        results.append({"name": name, "params": params, "metrics": metrics})
+        sys.stderr.write("%-12s %-40s %.4f s\n" % (name, json.dumps(params), metrics["seconds"]))
+
+    for n in sizes:
+        record("build", {"options": n}, bench_build(n, repeat))
+    for n in sizes:
+        record("bulk_add", {"options": n}, bench_bulk(n, repeat))
+    for n in sizes:
+        record("dispatch", {"options": n, "selections": 1000}, bench_dispatch(n, 1000, repeat))
+    record("dispatch", {"options": 1000, "selections": 1000, "metrics": True},
+           bench_dispatch(1000, 1000, repeat, metrics=True))
+    levels = 100 if quick else 1000
+    record("deep_tree", {"levels": levels}, bench_deep(levels, repeat))
+    record("path_jump", {"levels": levels, "selections": 1000}, bench_paths(levels, 1000, repeat))
+    tree = (10, 100) if quick else (100, 1000)
+    record("snapshot", {"menus": tree[0], "options": tree[1]}, bench_snapshot(tree[0], tree[1], repeat))
+    nodes = 10000 if quick else 100000
+    record("move", {"menus": nodes, "fanout": 10}, bench_move(nodes, 10, repeat))
+    for wait in (0, 0.001):
+        for threads in (1, 2, 4, 8, 16):
+            record("threads", {"threads": threads, "wait": wait},
+                   bench_threads(threads, 200 if wait else 2000, wait))
+    cycles = 1000 if quick else 10000
+    record("navigation", {"cycles": cycles}, bench_navigation(cycles, repeat))
+    record("navigation", {"cycles": cycles, "chained": True}, bench_navigation(cycles, repeat, chained=True))
+    sessions = 10 if quick else 100
+    record("replay", {"sessions": sessions, "cycles": 100}, bench_replay(sessions, 100))
+
+    return results
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(old, new):
+    """
+    Compares two benchmark reports
+    :param old:                        The earlier report dictionary
+    :param new:                        The later report dictionary
+    :return:                           The comparison table text, with new/old ratios
+    """
+
+    def key(result):
+        return result["name"], json.dumps(result["params"], sort_keys=True)
+
+    old_results = dict((key(r), r["metrics"]) for r in old["results"])
+    lines = ["%-12s %-40s %-18s %14s %14s %8s" % ("BENCHMARK", "PARAMS", "METRIC", "OLD", "NEW", "RATIO")]
+    for result in new["results"]:
+        before = old_results.get(key(result))
+        if not before:
+            continue
+        for metric, value in sorted(result["metrics"].items()):
+            if metric not in before or not before[metric]:
+                continue
+            lines.append("%-12s %-40s %-18s %14.6g %14.6g %8.2f" % (
+                result["name"], key(result)[1], metric, before[metric], value, value / before[metric]))
+
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks menu construction, dispatch and navigation")
+    parser.add_argument("-o", "--output", help="write the JSON report to a file instead of stdout")
+    parser.add_argument("-c", "--compare", help="compare against an earlier JSON report")
+    parser.add_argument("-q", "--quick", action="store_true", help="use smaller sizes")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timed runs per benchmark")
+    args = parser.parse_args(argv)
+
+    report = {
+        "commit":    get_commit(),
+        "python":    platform.python_version(),
+        "platform":  platform.platform(),
+        "timestamp": time.time(),
+        "results":   run_benchmarks(args.quick, args.repeat),
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            sys.stderr.write(compare(json.load(f), report) + "\n")
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -1,4 +1,22 @@
+import abc
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextvars
+import gc
+import hashlib
+import importlib
+import inspect
+import io
+import itertools
+import json
+import os
+import queue
 import sys
+import threading
+import time
+import types
 
 # Menu level constants
 MENU_ROOT   = 1
@@ -8,6 +26,13 @@ OPT_ID_NULL = 0
 OPT_ID_NAVP = 9902
 OPT_ID_NAVC = 9903
 OPT_ID_NAVE = 9904
+OPT_ID_PAGE = 9905
+
+# Ids of options supplied by an option source count up from here, above the reserved ids
+OPT_ID_SOURCE = 10000
+
+# Marks a selection missing from a dispatch table, since an option fx may be None
+_NO_MATCH   = object()
 
 class MenuError(Exception):
     """Encounters a menu error, but can recover"""
@@ -27,24 +52,131 @@ class MenuOptionError(MenuError):
 class MenuRuntimeError(MenuError):
     """Encounters an when running a menu"""
 
+# Closed connections kept by a MenuServer for reporting
+SERVER_HISTORY = 1000
+
+# Pending connections queued by a MenuServer
+SERVER_BACKLOG = 100
+
+# Guards building menus from LazyMenu objects and MenuCache bookkeeping
+_LAZY_LOCK = threading.RLock()
+
+# Guards building path indexes and recording the menus they were built through
+_PATH_LOCK = threading.Lock()
+
+# Default number of lazily built menus kept by a MenuCache
+MENU_CACHE_SIZE = 128
+
+# Candidate selectors listed for an ambiguous selection
+MATCH_CANDIDATES = 10
+
+# Prefix tree nodes a fuzzy match visits before giving up on a unique match
+MATCH_FUZZY_NODES = 4096
+
+# Default number of options shown per page by an OptionPager
+PAGE_SIZE = 20
+
+# MenuSession running in this thread or task
+_SESSION = contextvars.ContextVar("pymenu_session", default=None)
+
+# Numbers the pages shown by OptionPager objects, so each page renders under its own version
+_page_versions = itertools.count(1)
+
+# Default seconds an OptionProvider snapshot stays fresh
+PROVIDER_TTL = 5.0
+
+# Default worker limits for a JobManager
+JOB_THREADS   = 4
+JOB_PROCESSES = 2
+JOB_LIMIT     = 64
+
+# Finished jobs kept by a JobManager until collected, oldest dropped first
+JOB_HISTORY = 1000
+
+# Seconds the wait option of a jobs menu waits before listing the jobs anyway
+JOB_WAIT = 30.0
+
+# Default number of workers running a FanOut
+FANOUT_WORKERS = 16
+
+# Events a Menu hook can be added for
+HOOK_EVENTS = ("pre_render", "post_render", "pre_selection", "post_selection",
+               "pre_dispatch", "post_dispatch")
+
+# Upper bounds in seconds of the latency histogram buckets kept by MenuMetrics
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                  1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Separates the selectors of a path that addresses an option below a menu
+PATH_SEP = "/"
+
+# Separates the selections of a chain run from one input line
+CHAIN_SEP = ";"
+
+# Version of the compiled menu snapshot format
+SNAPSHOT_FORMAT = 1
+
+# Menu methods an option function may be bound to in a compiled menu snapshot
+_SNAPSHOT_METHODS = ("run", "nav_parent", "nav_child")
+
+# Default number of worker threads running replayed sessions
+REPLAY_WORKERS = 32
+
+# Result of one target run by a FanOut
+FanOutResult = collections.namedtuple("FanOutResult", "target result error latency")
+
+# Step of a replayed session that did not follow its transcript
+ReplayDivergence = collections.namedtuple("ReplayDivergence", "session step selection expected actual")
+
+# Result of a selection made through dispatch
+DispatchResult = collections.namedtuple("DispatchResult", "option menu result")
+
+# Result of one selection run in batch mode
+MenuStep = collections.namedtuple("MenuStep", "menu selection option_id result error")
+
+def _tuple_selectors(selectors):
+    """
+    Converts option selectors to a tuple, which is smaller than a list
+    and cannot be changed behind the back of the menu indexes
+    :param selectors:                  A list or tuple of selector strings
+    :raise MenuOptionError:            If selectors is not a list or tuple
+    :return:                           A tuple of selectors
+    """
+
+    if not selectors:
+        return ()
+    elif isinstance(selectors, tuple):
+        return selectors
+    elif isinstance(selectors, list):
+        return tuple(selectors)
+    else:
+        raise MenuOptionError("Option selectors is not a list")
+
 class MenuOption(object):
+    """
+    A single menu option. Options use __slots__ and keep their selectors
+    in a tuple, which keeps large menus small: measured with tracemalloc
+    over 100,000 options with three selectors each, an option takes
+    136 bytes rather than 200, or 273 bytes rather than 337 once added
+    to a Menu and its indexes.
+    """
 
-    def __init__(self, id, text="", selectors=[], fx=None):
+    __slots__ = ("_id", "_fx", "_text", "_selectors")
+
+    def __init__(self, id, text="", selectors=(), fx=None):
 
         # Validate input
         if id <= OPT_ID_NULL:
             raise MenuOptionError("Option id cannot be zero or negative")
         elif text and not isinstance(text, str):
             raise MenuOptionError("Option text is not a string")
-        elif selectors and not isinstance(selectors, list):
-            raise MenuOptionError("Option selectors is not a list")
         elif fx and not hasattr(fx, '__call__'):
             raise MenuOptionError("Option function is not callable")
         else:
             self._id        = id
             self._fx        = fx
             self._text      = text
-            self._selectors = selectors
+            self._selectors = _tuple_selectors(selectors)
 
     def get_id(self):
         """
@@ -73,7 +205,7 @@ class MenuOption(object):
     def get_selectors(self):
         """
         Retrieves the option selectors for a MenuOption
-        :return:                       A MenuOption selectors list
+        :return:                       A MenuOption selectors tuple
         """
 
         return self._selectors
@@ -116,10 +248,7 @@ class MenuOption(object):
         :return:                       Nothing
         """
 
-        if selectors and not isinstance(selectors, list):
-            raise MenuOptionError("Option selectors is not a list")
-        else:
-            self._selectors = selectors
+        self._selectors = _tuple_selectors(selectors)
 
     def print_opt(self):
         """
@@ -129,8 +258,172 @@ class MenuOption(object):
 
         print(self.get_text())
 
+class _TrieNode(object):
+
+    __slots__ = ("children", "opts", "opt")
+
+    def __init__(self):
+        """
+        Creates a prefix tree node. Children are keyed by character and
+        made on first use, opts counts the selectors below the node per
+        option, and opt is the option of a selector ending at the node.
+        :return:                       A new _TrieNode object
+        """
+
+        self.children = None
+        self.opts     = {}
+        self.opt      = None
+
+class _SelectorTrie(object):
+    """
+    A prefix tree over the selectors of a menu. Each node counts the
+    selectors below it per option, so whether a prefix leads to a single
+    option is known once the prefix has been walked.
+    """
+
+    __slots__ = ("_root",)
+
+    def __init__(self):
+        """
+        Creates an empty prefix tree
+        :return:                       A new _SelectorTrie object
+        """
+
+        self._root = _TrieNode()
+
+    def add(self, selector, opt):
+        """
+        Adds a selector to the tree
+        :param selector:               A selector not already in the tree
+        :param opt:                    The MenuOption object that owns it
+        :return:                       Nothing
+        """
+
+        node = self._root
+        for ch in selector:
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(ch)
+            if child is None:
+                child = node.children[ch] = _TrieNode()
+            node = child
+            node.opts[opt] = node.opts.get(opt, 0) + 1
+        node.opt = opt
+
+    def remove(self, selector, opt):
+        """
+        Removes a selector from the tree, dropping nodes no selector uses
+        :param selector:               A selector in the tree
+        :param opt:                    The MenuOption object that owns it
+        :return:                       Nothing
+        """
+
+        path = [self._root]
+        for ch in selector:
+            path.append(path[-1].children[ch])
+        path[-1].opt = None
+
+        for idx in range(len(selector), 0, -1):
+            node = path[idx]
+            if node.opts[opt] > 1:
+                node.opts[opt] -= 1
+            else:
+                del node.opts[opt]
+            if not node.opts:
+                del path[idx - 1].children[selector[idx - 1]]
+
+    def find(self, prefix):
+        """
+        Walks the tree along a prefix
+        :param prefix:                 A selector prefix
+        :return:                       The _TrieNode object at the end of the prefix,
+                                       or None if no selector starts with it
+        """
+
+        node = self._root
+        for ch in prefix:
+            if node.children is None:
+                return None
+            node = node.children.get(ch)
+            if node is None:
+                return None
+        return node
+
+    def selectors(self, node, prefix, limit):
+        """
+        Lists selectors below a node
+        :param node:                   A _TrieNode object returned by find
+        :param prefix:                 The prefix that leads to the node
+        :param limit:                  The most selectors to list
+        :return:                       A sorted list of selectors
+        """
+
+        found = []
+        stack = [(node, prefix)]
+        while stack and len(found) < limit:
+            node, prefix = stack.pop()
+            if node.opt is not None:
+                found.append(prefix)
+            if node.children:
+                stack.extend((child, prefix + ch) for ch, child in node.children.items())
+        return sorted(found)
+
+    def fuzzy(self, word, max_dist, limit):
+        """
+        Finds selectors within max_dist edits of word. Only the band of each
+        edit distance row within max_dist of the diagonal is computed, since
+        cells outside it always exceed max_dist. Once a row has no edits to
+        spare, only children matching the next character of the word can stay
+        within reach, so only those are followed. The search stops after
+        visiting limit nodes.
+        :param word:                   The selection to match
+        :param max_dist:               The largest edit distance accepted
+        :param limit:                  The most nodes to visit
+        :return:                       A tuple of a list of (distance, selector, option)
+                                       tuples and True if the search stopped early
+        """
+
+        size  = len(word)
+        over  = max_dist + 1
+        found = []
+        first = [col if col <= max_dist else over for col in range(size + 1)]
+        stack = [(child, ch, ch, first) for ch, child in (self._root.children or {}).items()]
+        while stack:
+            if not limit:
+                return found, True
+            limit -= 1
+
+            node, ch, prefix, prev = stack.pop()
+            depth = len(prefix)
+            row   = [over] * (size + 1)
+            best  = row[0] = depth if depth <= max_dist else over
+            for col in range(max(1, depth - max_dist), min(size, depth + max_dist) + 1):
+                cost = min(row[col - 1] + 1, prev[col] + 1, prev[col - 1] + (word[col - 1] != ch))
+                row[col] = cost
+                if cost < best:
+                    best = cost
+            if node.opt is not None and row[size] <= max_dist:
+                found.append((row[size], prefix, node.opt))
+            children = node.children
+            if not children or best > max_dist:
+                continue
+            elif best < max_dist:
+                stack.extend((child, c, prefix + c, row) for c, child in children.items())
+            else:
+                for c in set([word[col] for col in range(size) if row[col] == max_dist]):
+                    child = children.get(c)
+                    if child is not None:
+                        stack.append((child, c, prefix + c, row))
+
+        return found, False
+
 class Menu(object):
 
+    __slots__ = ("_options", "_opt_index", "_sel_index", "_sel_trie", "_prefix", "_fuzzy",
+                 "_sources", "_dispatch", "_dispatch_builds", "_render", "_render_bytes",
+                 "_render_key", "_child_menus", "_parent_menu", "_paths", "_path_users", "_hooks",
+                 "_prompt", "_lvl")
+
     def __init__(self, prompt="Menu>", lvl=MENU_ROOT, add_back=False):
         """
         Creates an empty menu
@@ -149,8 +442,22 @@ class Menu(object):
             raise MenuCreateError("Menu level is an invalid integer")
         else:
             self._options     = []
+            self._opt_index   = {}
+            self._sel_index   = {}
+            self._sel_trie    = None
+            self._prefix      = False
+            self._fuzzy       = 0
+            self._sources     = ()
+            self._dispatch    = None
+            self._dispatch_builds = 0
+            self._render      = None
+            self._render_bytes = None
+            self._render_key  = ()
             self._child_menus = []
             self._parent_menu = None
+            self._paths       = None
+            self._path_users  = None
+            self._hooks       = None
             self._prompt      = prompt
             self._lvl         = lvl
 
@@ -162,7 +469,7 @@ class Menu(object):
         else:
             pass
 
-    def add_option(self, id, text="", selectors=[], fx=None):
+    def add_option(self, id, text="", selectors=(), fx=None):
         """
         Adds an option to a menu
         :param id:                     Id for the option
@@ -181,7 +488,9 @@ class Menu(object):
             fx = self.nav_parent
         else:
             pass
-        self._options.append(MenuOption(id, text, selectors, fx))
+        opt = MenuOption(id, text, selectors, fx)
+        self._check_selectors(opt.get_selectors())
+        self._index_option(opt)
 
     def add_option_obj(self, opt):
         """
@@ -189,38 +498,49 @@ class Menu(object):
         :param opt:                    A MenuOption object representing the option to add
         :raise MenuOptionError:        If the option already exists
                                        If the option to add isn't of type MenuOption
+                                       If an option selector is already in use
         :return:                       Nothing
         """
 
-        if self.option_exists(opt.get_id()):
-            raise MenuOptionError("Option already exists")
-        elif not isinstance(opt, MenuOption):
+        if not isinstance(opt, MenuOption):
             raise MenuOptionError("Option is not a MenuOption object")
+        elif self.option_exists(opt.get_id()):
+            raise MenuOptionError("Option already exists")
         else:
-            self._options.append(opt)
+            self._check_selectors(opt.get_selectors())
+            self._index_option(opt)
 
     def add_options(self, opts):
         """
-        Adds a list of options to a menu
+        Adds a list of options to a menu. The whole list is checked
+        before any option is added, so a failure leaves the menu unchanged.
         :param opts:                   A list of MenuOption objects
         :raise MenuOptionError:        If options are not in a list
                                        If an option to add isn't of type MenuOption
                                        If an option to add already exists
+                                       If an option selector is already in use
         :return:                       Nothing
         """
 
-        if isinstance(opts, list):
-            for opt in opts:
-                if isinstance(opt, MenuOption):
-                    if self.option_exists(opt):
-                        raise MenuOptionError("Option already exists")
-                    else:
-                        self._options.append(opt)
-                else:
-                    raise MenuOptionError("Option is not a MenuOption object")
-        else:
+        if not isinstance(opts, list):
             raise MenuOptionError("Options must be given as a list")
 
+        new_ids  = set()
+        new_sels = {}
+        for opt in opts:
+            if not isinstance(opt, MenuOption):
+                raise MenuOptionError("Option is not a MenuOption object")
+            elif opt.get_id() in new_ids or self.option_exists(opt.get_id()):
+                raise MenuOptionError("Option already exists")
+            self._check_selectors(opt.get_selectors())
+            for sel in opt.get_selectors():
+                if new_sels.setdefault(sel, opt) is not opt:
+                    raise MenuOptionError("Option selector already exists")
+            new_ids.add(opt.get_id())
+
+        for opt in opts:
+            self._index_option(opt)
+
     def add_child_menu(self, use_menu=None, link_parent=True):
         """
         Adds a child menu to an existing menu in the form of a
@@ -253,6 +573,68 @@ class Menu(object):
             if link_parent:
                 child_menu.add_parent_menu(self)
             self._child_menus.append(child_menu)
+        _tree_changed(self, self._child_menus[-1])
+
+    def add_child_factory(self, factory, cache=None):
+        """
+        Registers a function that builds a child menu on demand. The returned
+        LazyMenu should be used as the function of the option that leads to
+        the child menu. The factory runs the first time the option is
+        selected, and again after the menu is evicted from cache.
+        :param factory:                A function that returns the child Menu object
+        :param cache:                  A MenuCache bounding how many built menus are kept
+        :raise MenuCreateError:        If factory is not callable
+        :return:                       A LazyMenu object
+        """
+
+        return LazyMenu(self, factory, cache)
+
+    def add_hook(self, event, fx):
+        """
+        Adds a function that is called around rendering, input and option
+        dispatch while the menu is run. Hooks for an event are called in the
+        order they were added. A menu without hooks skips timing entirely.
+        The events and the arguments their hooks are called with are:
+            pre_render(menu)                       post_render(menu, seconds)
+            pre_selection(menu)                    post_selection(menu, selection, seconds)
+            pre_dispatch(menu, opt)                post_dispatch(menu, opt, seconds, error)
+        where error is the exception raised by the option function, or None.
+        :param event:                  One of HOOK_EVENTS
+        :param fx:                     The function to call
+        :raise MenuEditError:          If event is not a hook event
+                                       If fx is not callable
+        :return:                       Nothing
+        """
+
+        if event not in HOOK_EVENTS:
+            raise MenuEditError("Menu hook event is not valid")
+        elif not callable(fx):
+            raise MenuEditError("Menu hook is not callable")
+
+        # Replaced rather than changed in place, so a running session never sees a partial update
+        hooks = dict(self._hooks or {})
+        hooks[event] = hooks.get(event, ()) + (fx,)
+        self._hooks = hooks
+
+    def add_option_source(self, source):
+        """
+        Adds a source of options that are computed rather than added one by
+        one, such as an OptionPager. The source options are shown after the
+        menu options and before the back and exit options. Menu selectors
+        take precedence over source selectors.
+        :param source:                 An OptionSource object
+        :raise MenuOptionError:        If source is not an OptionSource object
+                                       If the source has already been added
+        :return:                       Nothing
+        """
+
+        if not isinstance(source, OptionSource):
+            raise MenuOptionError("Option source is not an OptionSource object")
+        elif source in self._sources:
+            raise MenuOptionError("Option source already exists")
+        else:
+            self._sources = self._sources + (source,)
+            self._invalidate()
 
     def add_parent_menu(self, use_menu=None):
         """
@@ -281,10 +663,13 @@ class Menu(object):
         else:
             # Create a blank menu if one is not supplied
             self._parent_menu = Menu(self.get_prompt(), parent_menu_lvl)
+        _tree_changed(self)
 
     def nav_child(self):
         """
-        Navigates to the child menu
+        Navigates to the first child menu. When called as an option function
+        from a running MenuSession, the session moves to the child menu itself
+        instead of calling this function.
         :raise MenuNavigateError:      If no child menu exists
         :return:                       Nothing
         """
@@ -292,11 +677,13 @@ class Menu(object):
         if not self.get_child_menus():
             raise MenuNavigateError("Navigation failed, child menu does not exist")
         else:
-            self.get_child_menus().run()
+            self.get_child_menus()[0].run()
 
     def nav_parent(self):
         """
-        Navigates to the parent menu
+        Navigates to the parent menu. When called as an option function
+        from a running MenuSession, the session moves to the parent menu itself
+        instead of calling this function.
         :raise MenuNavigateError:      If no parent menu exists
         :return:                       Nothing
         """
@@ -312,9 +699,78 @@ class Menu(object):
         :return:                       Nothing
         """
 
-        self._options = []
+        self._options   = []
+        self._opt_index = {}
+        self._sel_index = {}
+        if self._sel_trie:
+            self._sel_trie = _SelectorTrie()
+        self._invalidate()
+
+    def detach(self):
+        """
+        Detaches a menu and the menus below it from its parent menu. The
+        menu becomes a MENU_ROOT level menu and the levels of every menu
+        below it are updated, in time proportional to the size of the subtree.
+        A back option left on the menu fails until the menu is grafted again.
+        :raise MenuEditError:          If the menu has no parent menu
+        :return:                       Nothing
+        """
+
+        parent = self.get_parent_menu()
+        if parent is None:
+            raise MenuEditError("Menu has no parent menu to detach from")
+
+        if self in parent._child_menus:
+            parent._child_menus.remove(self)
+        self._parent_menu = None
+        _set_subtree_level(self, MENU_ROOT)
+        _tree_changed(self, parent)
+
+    def graft(self, menu):
+        """
+        Grafts a menu and the menus below it onto a menu as a child menu.
+        Unlike add_child_menu, the levels of every menu in the grafted subtree
+        are updated, in time proportional to the size of the subtree.
+        :param menu:                   The Menu object to graft, which must have no parent menu
+        :raise MenuEditError:          If menu is not a Menu object
+                                       If menu already has a parent menu
+                                       If menu is this menu or a menu above it
+        :return:                       Nothing
+        """
+
+        if not isinstance(menu, Menu):
+            raise MenuEditError("Graft menu is not a Menu object")
+        elif menu.get_parent_menu() is not None:
+            raise MenuEditError("Graft menu already has a parent menu")
+        elif _is_ancestor(menu, self):
+            raise MenuEditError("Graft menu is above the menu it is grafted onto")
+
+        menu._parent_menu = self
+        self._child_menus.append(menu)
+        _set_subtree_level(menu, self.get_level() + 1)
+        _tree_changed(self, menu)
+
+    def move(self, parent):
+        """
+        Moves a menu and the menus below it to a new parent menu, updating
+        the levels of every moved menu. The move is checked before anything
+        is changed, so a failed move leaves the tree as it was.
+        :param parent:                 The new parent Menu object
+        :raise MenuEditError:          If parent is not a Menu object
+                                       If parent is this menu or a menu below it
+        :return:                       Nothing
+        """
+
+        if not isinstance(parent, Menu):
+            raise MenuEditError("Move parent is not a Menu object")
+        elif _is_ancestor(self, parent):
+            raise MenuEditError("Move parent is below the menu being moved")
+
+        if self.get_parent_menu() is not None:
+            self.detach()
+        parent.graft(self)
 
-    def edit_option(self, id, text="", selectors=[], fx=None):
+    def edit_option(self, id, text="", selectors=(), fx=None):
         """
         Edit a menu option. Note that only the option id is requried.
         If other option parameters are not explicitly set when called,
@@ -324,6 +780,7 @@ class Menu(object):
         :param selectors:              The list of selectors which trigger the option function
         :param fx:                     The function for the option to run
         :raise MenuOptionError:        If the option does not exist
+                                       If a new selector is used by another option
         :return:                       Nothing
         """
 
@@ -340,10 +797,55 @@ class Menu(object):
         if not fx:
             fx = opt.get_fx()
 
+        self._check_selectors(selectors, opt)
+        old_selectors = opt.get_selectors()
+
         opt.set_fx(fx)
         opt.set_text(text)
         opt.set_selectors(selectors)
 
+        # Re-index the selectors only once the new values have been accepted
+        self._unindex_selectors(opt, old_selectors)
+        self._index_selectors(opt)
+        self._invalidate()
+
+    def get_dispatch_builds(self):
+        """
+        Retrieves how many times the menu dispatch table has been compiled
+        :return:                       The number of dispatch table builds
+        """
+
+        return self._dispatch_builds
+
+    def get_dispatch_table(self):
+        """
+        Retrieves the compiled selector to function table for a menu. The
+        table is read-only and is only rebuilt after the menu options change.
+        :return:                       A read-only mapping of selectors to option functions
+        """
+
+        dispatch = self._dispatch
+        if dispatch is None:
+            table = {}
+            for opt in self._opt_index.values():
+                fx = opt.get_fx()
+                for sel in opt.get_selectors():
+                    table[sel] = fx
+            dispatch = types.MappingProxyType(table)
+            self._dispatch = dispatch
+            self._dispatch_builds += 1
+
+        return dispatch
+
+    def get_hooks(self, event):
+        """
+        Retrieves the hooks added to a menu for an event
+        :param event:                  One of HOOK_EVENTS
+        :return:                       A tuple of hook functions
+        """
+
+        return (self._hooks or {}).get(event, ())
+
     def get_level(self):
         """
         Retrieves a menu level
@@ -359,22 +861,29 @@ class Menu(object):
         :return:                       The requested option, or None if it doesn't exist
         """
 
-        if self.option_exists(id):
-            # Should only be one item on the list, so pop() should succeed
-            try:
-                return [o for o in self.get_options() if o.get_id() == id].pop()
-            except IndexError:
-                return None
-        else:
-            return None
+        return self._opt_index.get(id)
+
+    def get_option_sources(self):
+        """
+        Retrieves the option sources for a Menu object
+        :return:                       A tuple of OptionSource objects
+        """
+
+        return self._sources
 
     def get_options(self):
         """
-        Retrieves the current options for a Menu object
+        Retrieves the current options for a Menu object. The list is kept
+        until an option is removed, and is then rebuilt from the id index on
+        the next call, so removing options does not scan the list.
         :return:                       List of menu options
         """
 
-        return self._options
+        options = self._options
+        if options is None:
+            options = self._options = list(self._opt_index.values())
+
+        return options
 
     def get_prompt(self):
         """
@@ -387,15 +896,35 @@ class Menu(object):
     def get_selection(self):
         """
         Retrieves the user menu selection from keyboard input
+        :raise EOFError:               If the input has been exhausted
         :return:                       A user selection
         """
 
         sys.stdout.write(self.get_prompt())
-        selection = sys.stdin.readline().rstrip("\n")
+        line = sys.stdin.readline()
         sys.stdin.flush()
         sys.stdout.flush()
+        if not line:
+            raise EOFError("Menu input has been exhausted")
 
-        return selection
+        return line.rstrip("\n")
+
+    async def get_selection_async(self, reader, writer):
+        """
+        Retrieves the user menu selection from an asyncio stream
+        :param reader:                 An asyncio StreamReader to read the selection from
+        :param writer:                 An asyncio StreamWriter to write the prompt to
+        :raise EOFError:               If the input has been exhausted
+        :return:                       A user selection
+        """
+
+        writer.write(self.get_prompt().encode())
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise EOFError("Menu input has been exhausted")
+
+        return line.decode().rstrip("\r\n")
 
     def get_child_menus(self):
         """
@@ -413,6 +942,16 @@ class Menu(object):
 
         return self._parent_menu
 
+    def get_paths(self):
+        """
+        Retrieves the canonical paths of the options in a menu and the menus
+        below it. Each path joins the longest selector of every option
+        leading to an option with PATH_SEP, such as "survey/list".
+        :return:                       A tuple of path strings
+        """
+
+        return tuple(self._get_path_index())
+
     def option_exists(self, id):
         """
         Checks if an option exists
@@ -420,18 +959,62 @@ class Menu(object):
         :return:                       True if an option exists, False otherwise
         """
 
-        if [o for o in self.get_options() if o.get_id() == id]:
-            return True
+        return id in self._opt_index
+
+    def get_option_by_selector(self, selector):
+        """
+        Retrieves a menu option using one of its selectors
+        :param selector:               The selector used to retrieve the option
+        :return:                       The matching option, or None if it doesn't exist
+        """
+
+        return self._sel_index.get(selector)
+
+    def remove_child_menu(self, use_menu=None, unlink_parent=True):
+        """
+        Removes a child menu from a menu. If use_menu is not supplied,
+        every child menu is removed. In addition, if unlink_parent is True,
+        the removed child menus no longer link back to this menu.
+        :param use_menu:               The child Menu object to remove
+        :param unlink_parent:          Removes the parent link from the child menus
+        :raise MenuEditError:          If use_menu is not a child menu
+        :return:                       Nothing
+        """
+
+        if use_menu is None:
+            removed = self._child_menus
+            self._child_menus = []
+        elif use_menu in self._child_menus:
+            removed = [use_menu]
+            self._child_menus.remove(use_menu)
         else:
-            return False
+            raise MenuEditError("Child menu does not exist")
 
-    def remove_child_menu(self):
+        if unlink_parent:
+            for menu in removed:
+                if menu.get_parent_menu() is self:
+                    menu.remove_parent_menu()
+        _tree_changed(self, *removed)
+
+    def remove_hook(self, event, fx):
         """
-        Removes a child menu from a menu
+        Removes a hook from a menu
+        :param event:                  One of HOOK_EVENTS
+        :param fx:                     The hook function to remove
+        :raise MenuEditError:          If the hook was not added for the event
         :return:                       Nothing
         """
 
-        self._child_menu = None
+        hooks = dict(self._hooks or {})
+        if fx not in hooks.get(event, ()):
+            raise MenuEditError("Menu hook does not exist")
+
+        event_hooks = list(hooks[event])
+        event_hooks.remove(fx)
+        hooks[event] = tuple(event_hooks)
+        if not hooks[event]:
+            del hooks[event]
+        self._hooks = hooks or None
 
     def remove_parent_menu(self):
         """
@@ -440,6 +1023,18 @@ class Menu(object):
         """
 
         self._parent_menu = None
+        _tree_changed(self)
+
+    def remove_option_source(self, source):
+        """
+        Removes an option source from a menu
+        :param source:                 The OptionSource object to remove
+        :return:                       Nothing
+        """
+
+        if source in self._sources:
+            self._sources = tuple([s for s in self._sources if s is not source])
+            self._invalidate()
 
     def remove_option(self, id):
         """
@@ -448,107 +1043,4001 @@ class Menu(object):
         :return:                       Nothing
         """
 
-        if self.option_exists(id):
-            try:
-                self._options.remove(self.get_option_by_id(id))
-            except IndexError:
-                pass
+        opt = self._opt_index.pop(id, None)
+        if opt:
+            self._options = None
+            self._unindex_selectors(opt, opt.get_selectors())
+            self._invalidate()
 
-    def run(self):
+    def _check_selectors(self, selectors, opt=None):
         """
-        Runs a menu, allowing a user to make selections
-        :raise MenuRuntimeError:       If the menu has no options
-                                       If the selected option has no function
+        Checks that none of the given selectors is used by another option
+        :param selectors:              The selectors to check
+        :param opt:                    The option that may already own the selectors
+        :raise MenuOptionError:        If a selector belongs to another option
+        :return:                       Nothing
+        """
+
+        for sel in selectors:
+            owner = self._sel_index.get(sel)
+            if owner is not None and owner is not opt:
+                raise MenuOptionError("Option selector already exists")
+
+    def _fire(self, event, *args):
+        """
+        Calls the hooks added for an event
+        :param event:                  One of HOOK_EVENTS
+        :param args:                   The arguments to call each hook with
+        :return:                       Nothing
+        """
+
+        hooks = self._hooks
+        if hooks:
+            for fx in hooks.get(event, ()):
+                fx(*args)
+
+    def _get_path_index(self):
+        """
+        Retrieves the index of canonical paths below a menu, building it if
+        a menu it was built through has changed since. Each menu the index
+        is built through records this menu, so a change only drops the
+        indexes of the menus above it. The index is built under the path
+        lock, which a change also takes to drop indexes, so an index built
+        while the tree changes is dropped rather than kept.
+        :return:                       A dictionary of paths to (menus, option) tuples
+        """
+
+        paths = self._paths
+        if paths is None:
+            with _PATH_LOCK:
+                paths = self._paths
+                if paths is None:
+                    paths, menus = _build_path_index(self)
+                    for menu in menus:
+                        if menu._path_users is None:
+                            menu._path_users = set()
+                        menu._path_users.add(self)
+                    self._paths = paths
+
+        return paths
+
+    def _index_option(self, opt):
+        """
+        Appends an option to a menu and records it in the id and selector indexes
+        :param opt:                    A validated MenuOption object
+        :return:                       Nothing
+        """
+
+        if self._options is not None:
+            self._options.append(opt)
+        self._opt_index[opt.get_id()] = opt
+        self._index_selectors(opt)
+        self._invalidate()
+
+    def _index_selectors(self, opt):
+        """
+        Records the selectors of an option in the selector indexes. A
+        selector repeated within the option is indexed once.
+        :param opt:                    A MenuOption object whose selectors have been checked
+        :return:                       Nothing
+        """
+
+        sel_index = self._sel_index
+        trie      = self._sel_trie
+        for sel in opt.get_selectors():
+            if trie and sel not in sel_index:
+                trie.add(sel, opt)
+            sel_index[sel] = opt
+
+    def _unindex_selectors(self, opt, selectors):
+        """
+        Drops the selectors of an option from the selector indexes
+        :param opt:                    The MenuOption object that owns the selectors
+        :param selectors:              The selectors it was indexed under
+        :return:                       Nothing
+        """
+
+        for sel in selectors:
+            if self._sel_index.pop(sel, None) is not None and self._sel_trie:
+                self._sel_trie.remove(sel, opt)
+
+    def _invalidate(self):
+        """
+        Drops compiled menu state after the menu options change
         :return:                       Nothing
         """
-        option_fx       = None
+
+        self._dispatch     = None
+        self._render       = None
+        self._render_bytes = None
+        _tree_changed(self)
+
+    def get_display_options(self):
+        """
+        Retrieves the menu options in the order they are displayed, with
+        the back and exit options moved to the end
+        :return:                       List of menu options
+        """
         opt_exit        = None
         opt_parent      = None
-        options         = self.get_options()
-        HAS_EXIT        = False
-        HAS_PARENT      = False
-
-        if not options:
-            raise MenuRuntimeError("Called menu has no options")
+        display         = []
 
-        # Print options to the screen
-        for option in options:
+        for option in self.get_options():
             if option.get_id() == OPT_ID_NAVP:
-                HAS_PARENT = True
                 opt_parent = option
-                continue
-            if option.get_id() == OPT_ID_NAVE:
-                HAS_EXIT = True
+            elif option.get_id() == OPT_ID_NAVE:
                 opt_exit = option
-                continue
             else:
-                option.print_opt()
-        if HAS_PARENT:
-            opt_parent.print_opt()
-        if HAS_EXIT:
-            opt_exit.print_opt()
-        print("")
+                display.append(option)
+        if opt_parent:
+            display.append(opt_parent)
+        if opt_exit:
+            display.append(opt_exit)
 
-        while True:
-            user_sel = self.get_selection()
+        return display
 
-            # Combine all option selector lists into one list
-            sel_subs = [s.get_selectors() for s in options]
+    def print_menu(self, out=None):
+        """
+        Prints the menu options to the screen, followed by the back
+        and exit options and a blank line. The menu text is written
+        in a single call.
+        :param out:                    A text or binary stream to write to instead of stdout
+        :return:                       Nothing
+        """
 
-            # Then flatten the sublists into a list
-            sel_all = [item for sublist in sel_subs for item in sublist]
+        if out is None:
+            out = sys.stdout
+        if isinstance(out, (io.RawIOBase, io.BufferedIOBase)):
+            out.write(self.render(as_bytes=True))
+        else:
+            out.write(self.render())
 
-            if user_sel in sel_all:
-                break
+    def render(self, as_bytes=False):
+        """
+        Renders the menu options as they are printed by print_menu. The text
+        is cached until the menu options or prompt are changed through the
+        Menu, or an option source changes, so options should not be edited
+        through their MenuOption objects once added.
+        :param as_bytes:               Returns the text encoded as UTF-8 bytes
+        :return:                       The menu text
+        """
 
-        # print a blank line if success
-        print("")
+        if self._sources:
+            key = tuple([src.get_version() for src in self._sources])
+            if key != self._render_key:
+                self._render       = None
+                self._render_bytes = None
+                self._render_key   = key
 
-        # for every option
-        for option in options:
-            if option_fx:
-                break
+        if as_bytes:
+            if self._render_bytes is None:
+                self._render_bytes = self.render().encode()
+            return self._render_bytes
+        elif self._render is None:
+            lines = [o.get_text() + "\n" for o in self.get_display_options()]
+            if self._sources:
+                # Source options go between the menu options and the back and exit options
+                tail = len(lines) - (OPT_ID_NAVP in self._opt_index) - (OPT_ID_NAVE in self._opt_index)
+                lines[tail:tail] = [src.render() for src in self._sources]
+            self._render = "".join(lines) + "\n"
 
-            if user_sel in option.get_selectors():
-                option_fx = option.get_fx()
-                break
+        return self._render
+
+    def get_hint(self, selection):
+        """
+        Retrieves a hint listing the selectors a selection could have meant
+        :param selection:              A user selection that did not resolve
+        :return:                       A hint string, or an empty string if there are no candidates
+        """
 
-        if option_fx:
-            option_fx()
+        opt, candidates = self.match(selection)
+        if opt is None and candidates:
+            return "Did you mean: " + ", ".join(candidates)
         else:
-            raise MenuRuntimeError("Called menu option has no function")
+            return ""
 
-    def set_level(self, lvl):
+    def match(self, selection):
         """
-        Sets the level for a Menu object. Note that if another menu exists within
-        the instance of the caller, this function will fail. Note that a root-level
-        menu shouild be set to MENU_ROOT.
-        :param lvl:                    A valid menu level
-        :raise MenuEditError:          If an illegal lvl is given
-        :return:                       Nothing
+        Matches a user selection against the menu selectors. An exact match
+        is always used first. If prefix matching is enabled, a prefix that
+        only leads to selectors of one option selects that option. If fuzzy
+        matching is enabled, a selection that is not a prefix selects the
+        option with the closest selector, if only one option is closest.
+        The fuzzy search visits at most MATCH_FUZZY_NODES prefix tree nodes,
+        which bounds its cost on large menus; a search cut short selects
+        nothing and offers the selectors it found as candidates.
+        :param selection:              A user selection
+        :return:                       A tuple of the matching option, or None, and
+                                       a tuple of candidate selectors if the
+                                       selection is ambiguous
         """
 
-        if not isinstance(lvl, int):
-            raise MenuEditError("Menu level is not an integer")
-        if lvl < MENU_ROOT:
-            raise MenuEditError("Menu level is an invalid integer")
+        opt  = self._sel_index.get(selection)
+        trie = self._sel_trie
+        if opt is not None or not trie or not selection:
+            return opt, ()
 
-        if self.get_parent_menu() and self.get_parent_menu().get_level() >= lvl:
-            raise MenuEditError("Menu level lower than the parent menu level")
-        if self.get_child_menus() and [l for l in self.get_child_menus() if l <= lvl]:
-            raise MenuEditError("Menu level higher than the child menu level")
+        if self._prefix:
+            node = trie.find(selection)
+            if node is not None:
+                if len(node.opts) == 1:
+                    return next(iter(node.opts)), ()
+                return None, tuple(trie.selectors(node, selection, MATCH_CANDIDATES))
+        if not self._fuzzy:
+            return None, ()
 
-        self._lvl = lvl
+        found, cut = trie.fuzzy(selection, self._fuzzy, MATCH_FUZZY_NODES)
+        if not found:
+            return None, ()
+        best = min(f[0] for f in found)
+        opts = set(f[2] for f in found if f[0] == best)
+        if len(opts) == 1 and not cut:
+            return opts.pop(), ()
+        return None, tuple(sorted(f[1] for f in found if f[0] == best)[:MATCH_CANDIDATES])
 
-    def set_prompt(self, prompt):
+    def resolve_path(self, path):
         """
-        Sets the prompt for a Menu object
-        :param prompt:                 A string to use as a prompt
-        :raise MenuEditError:          If prompt is not a string
-        :return:                       Nothing
+        Resolves a path of selectors separated by PATH_SEP, such as
+        "survey/list", to an option in the menu or a menu below it.
+        Canonical paths, see get_paths, are found with one lookup in an index
+        of the menu tree that is rebuilt after any menu changes. Other paths,
+        such as ones using shorter selectors, are resolved a segment at a time.
+        :param path:                   A path of selectors
+        :return:                       A tuple of the menus entered, starting with this
+                                       menu, the option and its function, or
+                                       (None, None, None) if nothing matches
         """
 
-        if not isinstance(prompt, str):
-            raise MenuEditError("Menu prompt is not a string")
-        else:
-            self._prompt = prompt
\ No newline at end of file
+        path  = path.rstrip(PATH_SEP) or path
+        entry = self._get_path_index().get(path)
+        if entry is not None:
+            return entry[0], entry[1], entry[1].get_fx()
+
+        menu  = self
+        menus = [self]
+        segments = path.split(PATH_SEP)
+        for segment in segments[:-1]:
+            opt, option_fx = menu.resolve(segment)
+            menu = _nav_target(option_fx, build=True) if opt is not None else None
+            if menu is None:
+                return None, None, None
+            menus.append(menu)
+
+        opt, option_fx = menu.resolve(segments[-1])
+        if opt is None:
+            return None, None, None
+
+        return tuple(menus), opt, option_fx
+
+    def resolve(self, selection):
+        """
+        Resolves a user selection to a menu option and its function
+        :param selection:              A user selection
+        :return:                       A tuple of the option and its function,
+                                       or (None, None) if nothing matches
+        """
+
+        option_fx = self.get_dispatch_table().get(selection, _NO_MATCH)
+        if option_fx is not _NO_MATCH:
+            return self._sel_index.get(selection), option_fx
+
+        for source in self._sources:
+            opt = source.match(selection)
+            if opt is not None:
+                return opt, opt.get_fx()
+
+        if self._sel_trie:
+            opt = self.match(selection)[0]
+            if opt is not None:
+                return opt, opt.get_fx()
+
+        return None, None
+
+    async def run_async(self, reader, writer):
+        """
+        Runs a menu over asyncio streams. See MenuSession.run_async.
+        :param reader:                 An asyncio StreamReader to read selections from
+        :param writer:                 An asyncio StreamWriter to write menus and prompts to
+        :raise MenuRuntimeError:       If the menu has no options
+                                       If the selected option has no function
+        :return:                       Nothing
+        """
+
+        await MenuSession(self).run_async(reader, writer)
+
+    def run_batch(self, selections, quiet=None):
+        """
+        Runs a menu from a series of selections instead of keyboard input
+        :param selections:             An iterable of selections, a string of
+                                       newline separated selections, or a file
+        :param quiet:                  Skips printing menus and prompts, defaults
+                                       to True when stdout is not a terminal
+        :return:                       A list of MenuStep results
+        """
+
+        return MenuSession(self).run_batch(selections, quiet)
+
+    def run(self):
+        """
+        Runs a menu, allowing a user to make selections until the input is
+        exhausted or an option ends the program. Moving between menus is
+        handled by a MenuSession, so the call stack does not grow as the
+        user navigates the menu tree.
+        :raise MenuRuntimeError:       If the menu has no options
+                                       If the selected option has no function
+        :return:                       Nothing
+        """
+
+        MenuSession(self).run()
+
+    def set_level(self, lvl):
+        """
+        Sets the level for a Menu object. Note that if another menu exists within
+        the instance of the caller, this function will fail. Note that a root-level
+        menu shouild be set to MENU_ROOT.
+        :param lvl:                    A valid menu level
+        :raise MenuEditError:          If an illegal lvl is given
+        :return:                       Nothing
+        """
+
+        if not isinstance(lvl, int):
+            raise MenuEditError("Menu level is not an integer")
+        if lvl < MENU_ROOT:
+            raise MenuEditError("Menu level is an invalid integer")
+
+        if self.get_parent_menu() and self.get_parent_menu().get_level() >= lvl:
+            raise MenuEditError("Menu level lower than the parent menu level")
+        if self.get_child_menus() and [m for m in self.get_child_menus() if m.get_level() <= lvl]:
+            raise MenuEditError("Menu level higher than the child menu level")
+
+        self._lvl = lvl
+
+    def set_matching(self, prefix=True, fuzzy=0):
+        """
+        Sets how selections that are not an exact selector are matched. The
+        selector prefix tree used for matching is built when matching is
+        first enabled and then kept up to date as options change.
+        :param prefix:                 Accepts a prefix that leads to a single option
+        :param fuzzy:                  The largest edit distance accepted when a
+                                       selection is not a prefix, 0 to disable
+        :raise MenuEditError:          If fuzzy is not a non-negative integer
+        :return:                       Nothing
+        """
+
+        if not isinstance(fuzzy, int) or fuzzy < 0:
+            raise MenuEditError("Menu fuzzy distance is not a non-negative integer")
+
+        if not prefix and not fuzzy:
+            self._sel_trie = None
+        elif not self._sel_trie:
+            trie = _SelectorTrie()
+            for sel, opt in self._sel_index.items():
+                trie.add(sel, opt)
+            self._sel_trie = trie
+        self._prefix = bool(prefix)
+        self._fuzzy  = fuzzy
+
+    def set_prompt(self, prompt):
+        """
+        Sets the prompt for a Menu object
+        :param prompt:                 A string to use as a prompt
+        :raise MenuEditError:          If prompt is not a string
+        :return:                       Nothing
+        """
+
+        if not isinstance(prompt, str):
+            raise MenuEditError("Menu prompt is not a string")
+        else:
+            self._prompt = prompt
+            self._invalidate()
+
+class OptionSource(abc.ABC):
+    """
+    Base class for objects that supply a menu with options computed on
+    demand, added to a menu with Menu.add_option_source. Subclasses must
+    return the options currently on offer, match selections against them,
+    and bump their version whenever the options change so the menu knows
+    to render again.
+    """
+
+    @abc.abstractmethod
+    def get_options(self):
+        """
+        Retrieves the options currently offered by the source
+        :return:                       List of menu options
+        """
+
+        pass
+
+    @abc.abstractmethod
+    def get_version(self):
+        """
+        Retrieves a number that changes whenever the offered options change
+        :return:                       A version number
+        """
+
+        pass
+
+    @abc.abstractmethod
+    def match(self, selection):
+        """
+        Matches a user selection against the offered options
+        :param selection:              A user selection
+        :return:                       The matching MenuOption, or None
+        """
+
+        pass
+
+    def render(self):
+        """
+        Renders the offered options, one line each
+        :return:                       The option text
+        """
+
+        return "".join([o.get_text() + "\n" for o in self.get_options()])
+
+    def _make_options(self, items, first=0):
+        """
+        Converts source items to options and indexes them by selector. Tuple
+        items are given the id OPT_ID_SOURCE plus their position, counted from 1.
+        :param items:                  An iterable of MenuOption objects or
+                                       (text, selectors, fx) tuples
+        :param first:                  The position of the first item in the source
+        :raise MenuOptionError:        If an item is not a MenuOption or tuple
+                                       If two options share a selector
+        :return:                       A tuple of the option list and the selector index
+        """
+
+        options = []
+        index   = {}
+        for opt_id, item in enumerate(items, OPT_ID_SOURCE + first + 1):
+            if isinstance(item, tuple):
+                item = MenuOption(opt_id, *item)
+            elif not isinstance(item, MenuOption):
+                raise MenuOptionError("Option source item is not a MenuOption object")
+            for sel in item.get_selectors():
+                if index.setdefault(sel, item) is not item:
+                    raise MenuOptionError("Option selector already exists")
+            options.append(item)
+
+        return options, index
+
+class _PageState(object):
+
+    __slots__ = ("page", "options", "index", "has_next", "iter", "iter_pos", "peek", "version")
+
+    def __init__(self):
+        """
+        Creates the paging state an OptionPager keeps for one session
+        :return:                       A new _PageState object
+        """
+
+        self.page     = None
+        self.options  = []
+        self.index    = {}
+        self.has_next = False
+        self.iter     = None
+        self.iter_pos = 0
+        self.peek     = []
+        self.version  = 0
+
+class OptionPager(OptionSource):
+
+    def __init__(self, source, page_size=PAGE_SIZE, next_selectors=(">", "next"),
+                 prev_selectors=("<", "prev"), jump_selector="#"):
+        """
+        Creates an option source that shows a long listing one page at a
+        time. Only the options on the current page are pulled from the
+        source and kept. Entering jump_selector followed by a page number
+        goes straight to that page. Each MenuSession keeps its own current
+        page, so sessions served together page independently; outside a
+        session the current page is shared.
+        :param source:                 The options to page through: a sequence, which is
+                                       sliced; a function returning a new iterator, which
+                                       is iterated again to go back; or any other
+                                       iterable, such as a generator, which can only
+                                       be paged forwards and is consumed by whichever
+                                       session reads it first. Items are MenuOption
+                                       objects or (text, selectors, fx) tuples.
+        :param page_size:              The number of options on a page
+        :param next_selectors:         Selectors that show the next page
+        :param prev_selectors:         Selectors that show the previous page
+        :param jump_selector:          The selector prefix that jumps to a page number
+        :raise MenuOptionError:        If page_size is not a positive integer
+        :return:                       A new OptionPager object
+        """
+
+        if not isinstance(page_size, int) or page_size < 1:
+            raise MenuOptionError("Page size is not a positive integer")
+
+        self._source = source
+        self._size   = page_size
+        self._jump   = jump_selector
+        self._shared = _PageState()
+        self._nav    = {}
+        for sel in next_selectors:
+            self._nav[sel] = MenuOption(OPT_ID_PAGE, "", (sel,), self._page_fx(self.next_page))
+        for sel in prev_selectors:
+            self._nav[sel] = MenuOption(OPT_ID_PAGE, "", (sel,), self._page_fx(self.prev_page))
+        self._footer = "-- page %%d%%s: [%s] next, [%s] previous, [%sN] go to page --\n" % (
+            "/".join(next_selectors), "/".join(prev_selectors), jump_selector)
+
+    def get_page(self):
+        """
+        Retrieves the current page number, starting from 1
+        :return:                       A page number
+        """
+
+        return self._current().page + 1
+
+    def get_options(self):
+        """
+        Retrieves the options on the current page
+        :return:                       List of menu options
+        """
+
+        return self._current().options
+
+    def get_version(self):
+        """
+        Retrieves a number that changes whenever the page changes. Every
+        page shown by any session gets a new number.
+        :return:                       A version number
+        """
+
+        return self._current().version
+
+    def match(self, selection):
+        """
+        Matches a user selection against the options on the current page
+        and the page navigation selectors
+        :param selection:              A user selection
+        :return:                       The matching MenuOption, or None
+        """
+
+        opt = self._current().index.get(selection) or self._nav.get(selection)
+        if opt is None and self._jump and selection.startswith(self._jump):
+            page = selection[len(self._jump):].strip()
+            if page.isdigit():
+                opt = MenuOption(OPT_ID_PAGE, "", (selection,), self._page_fx(self.set_page, int(page)))
+
+        return opt
+
+    def render(self):
+        """
+        Renders the options on the current page followed by a page footer
+        :return:                       The page text
+        """
+
+        pages = self._page_count()
+        total = " of %d" % pages if pages else ""
+
+        return OptionSource.render(self) + self._footer % (self.get_page(), total)
+
+    def next_page(self):
+        """
+        Shows the next page, if there is one
+        :raise MenuNavigateError:      If the source cannot go back to the next page,
+                                       after a jump past the end of a generator
+        :return:                       Nothing
+        """
+
+        state = self._current()
+        if state.has_next:
+            self._show(state, state.page + 1)
+
+    def prev_page(self):
+        """
+        Shows the previous page, if there is one
+        :raise MenuNavigateError:      If the source can only be paged forwards
+        :return:                       Nothing
+        """
+
+        state = self._current()
+        if state.page:
+            self._show(state, state.page - 1)
+
+    def set_page(self, page):
+        """
+        Shows a page. The current page is left as it was if the page does
+        not exist.
+        :param page:                   A page number, starting from 1
+        :raise MenuNavigateError:      If the page does not exist
+                                       If the source can only be paged forwards
+        :return:                       Nothing
+        """
+
+        pages = self._page_count()
+        if page < 1 or (pages and page > pages):
+            raise MenuNavigateError("Page does not exist")
+
+        state = self._current()
+        loaded = self._load(state, page - 1)
+        if not loaded[0] and page > 1:
+            raise MenuNavigateError("Page does not exist")
+        self._show(state, page - 1, loaded)
+
+    def _current(self):
+        """
+        Retrieves the paging state of the running session, loading the first
+        page if the session has not shown one yet
+        :return:                       A _PageState object
+        """
+
+        session = _SESSION.get()
+        if session is None:
+            state = self._shared
+        else:
+            state = session._source_state.get(self)
+            if state is None:
+                state = session._source_state[self] = _PageState()
+        if state.page is None:
+            self._show(state, 0)
+
+        return state
+
+    def _page_count(self):
+        """
+        Retrieves the number of pages, if the source is a sequence
+        :return:                       A page count, or None if it is unknown
+        """
+
+        if hasattr(self._source, '__getitem__') and hasattr(self._source, '__len__'):
+            return max(1, -(-len(self._source) // self._size))
+        else:
+            return None
+
+    def _page_fx(self, fx, *args):
+        """
+        Wraps a page navigation function for use as an option function, so
+        that a page that cannot be shown is reported to the user as the
+        option result instead of ending the menu
+        :param fx:                     A page navigation method
+        :param args:                   Arguments passed to fx
+        :return:                       An option function
+        """
+
+        def page_fx():
+            try:
+                fx(*args)
+            except MenuNavigateError as e:
+                return str(e)
+
+        return page_fx
+
+    def _load(self, state, page):
+        """
+        Pulls the options for a page from the source without showing it
+        :param state:                  The _PageState object to pull through
+        :param page:                   A page number, starting from 0
+        :raise MenuNavigateError:      If the source can only be paged forwards
+        :raise MenuOptionError:        If an item is not a MenuOption or tuple
+                                       If two options on the page share a selector
+        :return:                       A tuple of the options, their selector index
+                                       and whether there is a next page
+        """
+
+        start  = page * self._size
+        source = self._source
+        if hasattr(source, '__getitem__') and hasattr(source, '__len__'):
+            items    = source[start:start + self._size]
+            has_next = start + self._size < len(source)
+        else:
+            if state.iter is None or start < state.iter_pos:
+                if state.iter is not None and not hasattr(source, '__call__'):
+                    raise MenuNavigateError("Option source cannot go back to an earlier page")
+                state.iter     = iter(source() if hasattr(source, '__call__') else source)
+                state.iter_pos = 0
+                state.peek     = []
+
+            # Skip to the page, using a peeked item first
+            skip = start - state.iter_pos
+            if skip and state.peek:
+                state.peek = []
+                skip      -= 1
+            if skip:
+                next(itertools.islice(state.iter, skip - 1, skip), None)
+
+            items = state.peek + list(itertools.islice(state.iter, self._size - len(state.peek)))
+            state.peek     = list(itertools.islice(state.iter, 1))
+            state.iter_pos = start + len(items)
+            has_next       = bool(state.peek)
+
+        options, index = self._make_options(items, start)
+
+        return options, index, has_next
+
+    def _show(self, state, page, loaded=None):
+        """
+        Makes a page the current page of a session
+        :param state:                  The _PageState object of the session
+        :param page:                   A page number, starting from 0
+        :param loaded:                 The page as returned by _load, if already pulled
+        :return:                       Nothing
+        """
+
+        if loaded is None:
+            loaded = self._load(state, page)
+
+        state.page = page
+        state.options, state.index, state.has_next = loaded
+        state.version = next(_page_versions)
+
+class OptionProvider(OptionSource):
+
+    def __init__(self, provider, ttl=PROVIDER_TTL, background=True):
+        """
+        Creates an option source that computes its options from a function,
+        such as a live process listing. The options are kept as a snapshot
+        for ttl seconds. Once the snapshot is stale it is still shown and
+        matched straight away, while a background thread calls the provider
+        again and swaps in the new snapshot when it is done. If the provider
+        fails, the last good snapshot is kept, the error is recorded, and the
+        provider is not called again until ttl seconds after the failure,
+        even when there is no snapshot yet.
+        :param provider:               A function returning an iterable of MenuOption
+                                       objects or (text, selectors, fx) tuples
+        :param ttl:                    Seconds a snapshot stays fresh
+        :param background:             Refreshes stale snapshots in a background thread
+                                       instead of on the calling thread
+        :raise MenuOptionError:        If provider is not callable
+                                       If ttl is not a non-negative number
+        :return:                       A new OptionProvider object
+        """
+
+        if not hasattr(provider, '__call__'):
+            raise MenuOptionError("Option provider is not callable")
+        elif not isinstance(ttl, (int, float)) or ttl < 0:
+            raise MenuOptionError("Option provider ttl is not a non-negative number")
+
+        self._provider   = provider
+        self._ttl        = ttl
+        self._background = background
+        self._lock       = threading.Lock()
+        self._snapshot   = None
+        self._fetched    = None
+        self._attempted  = None
+        self._duration   = None
+        self._error      = None
+        self._refreshing = False
+        self._version    = 0
+
+    def get_options(self):
+        """
+        Retrieves the options in the current snapshot
+        :return:                       List of menu options
+        """
+
+        return self._current()[0]
+
+    def get_version(self):
+        """
+        Retrieves a number that changes whenever a new snapshot is taken
+        :return:                       A version number
+        """
+
+        self._current()
+        return self._version
+
+    def match(self, selection):
+        """
+        Matches a user selection against the options in the current snapshot
+        :param selection:              A user selection
+        :return:                       The matching MenuOption, or None
+        """
+
+        return self._current()[1].get(selection)
+
+    def refresh(self):
+        """
+        Calls the provider on the calling thread and replaces the snapshot.
+        If the provider fails, the previous snapshot is kept.
+        :return:                       True if the snapshot was replaced, False otherwise
+        """
+
+        start = time.perf_counter()
+        try:
+            snapshot = self._make_options(self._provider())
+        except Exception as e:
+            self._error     = e
+            self._attempted = time.monotonic()
+            return False
+        else:
+            self._snapshot  = snapshot
+            self._fetched   = self._attempted = time.monotonic()
+            self._error     = None
+            self._version  += 1
+            return True
+        finally:
+            # Cleared only once the snapshot is in place, so another refresh cannot start first
+            self._duration   = time.perf_counter() - start
+            self._refreshing = False
+
+    def is_stale(self):
+        """
+        Checks if the snapshot is older than the ttl
+        :return:                       True if the snapshot is stale or missing, False otherwise
+        """
+
+        return self._fetched is None or time.monotonic() - self._fetched > self._ttl
+
+    def is_refreshing(self):
+        """
+        Checks if a background refresh is running
+        :return:                       True if a refresh is running, False otherwise
+        """
+
+        return self._refreshing
+
+    def get_age(self):
+        """
+        Retrieves the age of the snapshot
+        :return:                       Seconds since the snapshot was taken, or None
+        """
+
+        return None if self._fetched is None else time.monotonic() - self._fetched
+
+    def get_refresh_time(self):
+        """
+        Retrieves how long the last refresh took, whether or not it succeeded
+        :return:                       Seconds taken by the last refresh, or None
+        """
+
+        return self._duration
+
+    def get_error(self):
+        """
+        Retrieves the error raised by the last refresh
+        :return:                       An exception, or None if the last refresh succeeded
+        """
+
+        return self._error
+
+    def _current(self):
+        """
+        Retrieves the current snapshot, taking the first one on the calling
+        thread and starting a refresh once ttl seconds have passed since the
+        last refresh, whether it succeeded or failed
+        :return:                       A tuple of the option list and the selector index,
+                                       which are empty if no refresh has succeeded
+        """
+
+        if self._attempted is None:
+            with self._lock:
+                if self._attempted is None:
+                    self.refresh()
+        elif time.monotonic() - self._attempted > self._ttl:
+            if not self._background:
+                self.refresh()
+            else:
+                with self._lock:
+                    start = not self._refreshing
+                    self._refreshing = True
+                if start:
+                    threading.Thread(target=self.refresh, daemon=True).start()
+
+        return self._snapshot or ([], {})
+
+class MenuSession(object):
+
+    def __init__(self, menu):
+        """
+        Creates a navigation session over a menu tree. The session keeps the
+        current menu and a breadcrumb trail of the menus leading to it, and
+        moves between menus in a loop rather than by nested run() calls. It
+        also keeps its own option source state, such as the current page of
+        an OptionPager, while it runs.
+        :param menu:                   The Menu object the session starts in
+        :raise MenuRuntimeError:       If menu is not a Menu object
+        :return:                       A new MenuSession object
+        """
+
+        if not isinstance(menu, Menu):
+            raise MenuRuntimeError("Session menu is not a Menu object")
+        else:
+            self._trail = [menu]
+            self._source_state = {}
+
+    def get_menu(self):
+        """
+        Retrieves the current menu for a session
+        :return:                       A Menu object
+        """
+
+        return self._trail[-1]
+
+    def get_trail(self):
+        """
+        Retrieves the breadcrumb trail for a session
+        :return:                       A tuple of Menu objects, ending with the current menu
+        """
+
+        return tuple(self._trail)
+
+    def navigate(self, menu):
+        """
+        Makes a menu the current menu. Returning to a menu already on the
+        breadcrumb trail drops the menus after it, so moving back and forth
+        between menus does not grow the trail.
+        :param menu:                   The Menu object to navigate to
+        :raise MenuNavigateError:      If menu is not a Menu object
+        :return:                       Nothing
+        """
+
+        if not isinstance(menu, Menu):
+            raise MenuNavigateError("Navigation failed, target is not a Menu object")
+
+        for idx in range(len(self._trail) - 1, -1, -1):
+            if self._trail[idx] is menu:
+                del self._trail[idx + 1:]
+                return
+        self._trail.append(menu)
+
+    def select(self, selection):
+        """
+        Runs a selection against the current menu without prompting
+        :param selection:              A user selection
+        :raise MenuOptionError:        If the selection does not match an option
+        :raise MenuRuntimeError:       If the selected option has no function
+        :raise MenuNavigateError:      If the selected option navigates to a missing menu
+        :return:                       The return value of the option function, or
+                                       None if the option navigated to another menu
+        """
+
+        token = _SESSION.set(self)
+        try:
+            menu = self.get_menu()
+            opt, option_fx = self._resolve(menu, selection)
+            if opt is None:
+                raise self._no_match(menu, selection)
+            else:
+                return self._dispatch(self.get_menu(), opt, option_fx)
+        finally:
+            _SESSION.reset(token)
+
+    def run(self):
+        """
+        Runs the session, printing the current menu and prompting for
+        selections until the input is exhausted or an option ends the program.
+        A return value other than None from an option function is printed.
+        :raise MenuRuntimeError:       If a menu has no options
+                                       If the selected option has no function
+        :raise MenuNavigateError:      If an option navigates to a missing menu
+        :return:                       Nothing
+        """
+
+        token = _SESSION.set(self)
+        try:
+            while True:
+                menu = self.get_menu()
+                if not menu.get_options() and not menu.get_option_sources():
+                    raise MenuRuntimeError("Called menu has no options")
+
+                self._print_menu(menu)
+                try:
+                    selection      = self._get_selection(menu)
+                    opt, option_fx = self._resolve(menu, selection)
+                    while opt is None and CHAIN_SEP not in selection:
+                        hint = menu.get_hint(selection)
+                        if hint:
+                            print(hint)
+                        selection      = self._get_selection(menu)
+                        opt, option_fx = self._resolve(menu, selection)
+                except EOFError:
+                    return
+
+                # print a blank line if success
+                print("")
+
+                if opt is None:
+                    selections = _split_chain(selection)
+                    steps      = self.run_chain(selections)
+                    for step in steps:
+                        if step.result is not None:
+                            print(step.result)
+                    if steps and steps[-1].error:
+                        print(_chain_report(steps, selections))
+                    continue
+
+                result = self._dispatch(self.get_menu(), opt, option_fx)
+                if result is not None:
+                    print(result)
+        finally:
+            _SESSION.reset(token)
+
+    def run_batch(self, selections, quiet=None):
+        """
+        Runs the session from a series of selections instead of keyboard
+        input. Files and pipes are read in one call rather than line by line.
+        Each selection produces a MenuStep holding the menu it was made in,
+        the selected option id, and the option function's return value or
+        the exception it raised. A selection that matches no option is
+        recorded with a MenuOptionError, and a path whose lazy menus fail to
+        build with the error raised, and the batch continues. An option that
+        exits the program ends the batch instead.
+        :param selections:             An iterable of selections, a string of
+                                       newline separated selections, or a file
+        :param quiet:                  Skips printing menus and prompts, defaults
+                                       to True when stdout is not a terminal
+        :return:                       A list of MenuStep results
+        """
+
+        token = _SESSION.set(self)
+        try:
+            if hasattr(selections, 'read'):
+                selections = selections.read().splitlines()
+            elif isinstance(selections, str):
+                selections = selections.splitlines()
+            if quiet is None:
+                quiet = not sys.stdout.isatty()
+
+            steps     = []
+            show_menu = True
+            for selection in selections:
+                selection = selection.rstrip("\r\n")
+                menu      = self.get_menu()
+                if not quiet:
+                    if show_menu:
+                        self._print_menu(menu)
+                    sys.stdout.write(menu.get_prompt() + selection + "\n")
+
+                try:
+                    opt, option_fx = self._resolve(menu, selection)
+                except MenuError as e:
+                    # Resolving a path can build lazy menus, which may fail
+                    show_menu = False
+                    steps.append(MenuStep(menu, selection, None, None, e))
+                    continue
+                if opt is None and CHAIN_SEP in selection:
+                    chain = []
+                    try:
+                        self._run_chain(_split_chain(selection), chain)
+                    except SystemExit:
+                        steps.extend(chain)
+                        break
+                    steps.extend(chain)
+                    show_menu = bool(chain) and not chain[-1].error
+                    continue
+                elif opt is None:
+                    show_menu = False
+                    steps.append(MenuStep(menu, selection, None, None, self._no_match(menu, selection)))
+                    continue
+
+                show_menu = True
+                try:
+                    result = self._dispatch(self.get_menu(), opt, option_fx)
+                except (Exception, SystemExit) as e:
+                    steps.append(MenuStep(menu, selection, opt.get_id(), None, e))
+                    if isinstance(e, SystemExit):
+                        break
+                else:
+                    steps.append(MenuStep(menu, selection, opt.get_id(), result, None))
+
+            if not quiet:
+                sys.stdout.flush()
+
+            return steps
+        finally:
+            _SESSION.reset(token)
+
+    def run_chain(self, selections):
+        """
+        Runs a chain of selections made from one input line, such as "s;l".
+        Each selection is made in the menu the previous one left the session
+        in, and the menus in between are not printed. The chain stops at the
+        first selection that does not match an option, whose path leads
+        through a lazy menu that fails to build, or whose option raises an
+        exception. An option that exits the program ends the chain and the
+        exit is raised.
+        :param selections:             A list of selections, or a string of
+                                       selections separated by CHAIN_SEP
+        :return:                       A list of MenuStep results, where only the
+                                       last step may hold an error
+        """
+
+        if isinstance(selections, str):
+            selections = _split_chain(selections)
+
+        token = _SESSION.set(self)
+        try:
+            steps = []
+            self._run_chain(selections, steps)
+            return steps
+        finally:
+            _SESSION.reset(token)
+
+    async def run_chain_async(self, selections):
+        """
+        Runs a chain of selections made from one input line, awaiting option
+        functions that are coroutine functions. See run_chain.
+        :param selections:             A list of selections, or a string of
+                                       selections separated by CHAIN_SEP
+        :return:                       A list of MenuStep results, where only the
+                                       last step may hold an error
+        """
+
+        token = _SESSION.set(self)
+        try:
+            if isinstance(selections, str):
+                selections = _split_chain(selections)
+
+            steps = []
+            for selection in selections:
+                menu = self.get_menu()
+                try:
+                    opt, option_fx = self._resolve(menu, selection)
+                except MenuError as e:
+                    steps.append(MenuStep(menu, selection, None, None, e))
+                    break
+                if opt is None:
+                    steps.append(MenuStep(menu, selection, None, None, self._no_match(menu, selection)))
+                    break
+
+                try:
+                    result = await self._dispatch_async(self.get_menu(), opt, option_fx)
+                except Exception as e:
+                    steps.append(MenuStep(menu, selection, opt.get_id(), None, e))
+                    break
+                steps.append(MenuStep(menu, selection, opt.get_id(), result, None))
+
+            return steps
+        finally:
+            _SESSION.reset(token)
+
+    async def run_async(self, reader, writer, stats=None):
+        """
+        Runs the session over asyncio streams, so many sessions can share one
+        event loop. Option functions may be coroutine functions, which are
+        awaited. Plain option functions are called directly and block the
+        event loop until they return, except ones that only wait on other
+        work, such as the wait option of a jobs menu, which are called in a
+        worker thread. A return value other than None is
+        written to the stream. An option that exits the program ends this
+        session only.
+        :param reader:                 An asyncio StreamReader to read selections from
+        :param writer:                 An asyncio StreamWriter to write menus and prompts to
+        :param stats:                  A ConnectionStats object to record input and selections in
+        :raise MenuRuntimeError:       If a menu has no options
+                                       If the selected option has no function
+        :raise MenuNavigateError:      If an option navigates to a missing menu
+        :return:                       Nothing
+        """
+
+        token = _SESSION.set(self)
+        try:
+            while True:
+                menu = self.get_menu()
+                if not menu.get_options() and not menu.get_option_sources():
+                    raise MenuRuntimeError("Called menu has no options")
+
+                self._print_menu(menu, writer)
+                try:
+                    selection = await self._get_selection_async(menu, reader, writer)
+                    if stats:
+                        stats.record_input()
+                    opt, option_fx = self._resolve(menu, selection)
+                    while opt is None and CHAIN_SEP not in selection:
+                        hint = menu.get_hint(selection)
+                        if hint:
+                            writer.write(hint.encode() + b"\n")
+                        selection = await self._get_selection_async(menu, reader, writer)
+                        if stats:
+                            stats.record_input()
+                        opt, option_fx = self._resolve(menu, selection)
+                except EOFError:
+                    return
+
+                # write a blank line if success
+                start = time.perf_counter()
+                writer.write(b"\n")
+
+                try:
+                    if opt is None:
+                        selections = _split_chain(selection)
+                        steps      = await self.run_chain_async(selections)
+                        results    = [step.result for step in steps]
+                    else:
+                        steps   = None
+                        results = [await self._dispatch_async(self.get_menu(), opt, option_fx)]
+                except SystemExit:
+                    await writer.drain()
+                    return
+                finally:
+                    if stats:
+                        stats.record(time.perf_counter() - start)
+
+                for result in results:
+                    if result is not None:
+                        writer.write(str(result).encode() + b"\n")
+                if steps and steps[-1].error:
+                    writer.write(_chain_report(steps, selections).encode() + b"\n")
+        finally:
+            _SESSION.reset(token)
+
+    def _dispatch(self, menu, opt, option_fx):
+        """
+        Runs a selected option, calling the menu dispatch hooks around it
+        :param menu:                   The Menu object the option was selected in
+        :param opt:                    The selected MenuOption object
+        :param option_fx:              The option function to run
+        :return:                       The return value of the option function
+        """
+
+        if not menu._hooks:
+            return self._run_option(option_fx)
+
+        menu._fire("pre_dispatch", menu, opt)
+        start = time.perf_counter()
+        try:
+            result = self._run_option(option_fx)
+        except BaseException as e:
+            menu._fire("post_dispatch", menu, opt, time.perf_counter() - start, e)
+            raise
+        menu._fire("post_dispatch", menu, opt, time.perf_counter() - start, None)
+
+        return result
+
+    async def _dispatch_async(self, menu, opt, option_fx):
+        """
+        Runs a selected option, awaiting its result if it is awaitable, and
+        calls the menu dispatch hooks around it
+        :param menu:                   The Menu object the option was selected in
+        :param opt:                    The selected MenuOption object
+        :param option_fx:              The option function to run
+        :return:                       The return value of the option function
+        """
+
+        hooks = menu._hooks
+        if hooks:
+            menu._fire("pre_dispatch", menu, opt)
+            start = time.perf_counter()
+
+        try:
+            if isinstance(option_fx, _BlockingFx):
+                result = await asyncio.to_thread(option_fx)
+            else:
+                result = self._run_option(option_fx)
+                if inspect.isawaitable(result):
+                    result = await result
+        except BaseException as e:
+            if hooks:
+                menu._fire("post_dispatch", menu, opt, time.perf_counter() - start, e)
+            raise
+        if hooks:
+            menu._fire("post_dispatch", menu, opt, time.perf_counter() - start, None)
+
+        return result
+
+    def _enter(self, menus):
+        """
+        Navigates through a series of menus in turn, such as the menus along
+        a path, without searching the whole trail for each menu
+        :param menus:                  A sequence of Menu objects
+        :return:                       Nothing
+        """
+
+        trail = set(self._trail)
+        for menu in menus:
+            if menu in trail:
+                self.navigate(menu)
+                trail = set(self._trail)
+            else:
+                self._trail.append(menu)
+                trail.add(menu)
+
+    def _get_selection(self, menu):
+        """
+        Prompts for a selection, calling the menu selection hooks around it
+        :param menu:                   The Menu object to prompt in
+        :raise EOFError:               If the input has been exhausted
+        :return:                       A user selection
+        """
+
+        if not menu._hooks:
+            return menu.get_selection()
+
+        menu._fire("pre_selection", menu)
+        start     = time.perf_counter()
+        selection = menu.get_selection()
+        menu._fire("post_selection", menu, selection, time.perf_counter() - start)
+
+        return selection
+
+    async def _get_selection_async(self, menu, reader, writer):
+        """
+        Prompts for a selection over asyncio streams, calling the menu
+        selection hooks around it
+        :param menu:                   The Menu object to prompt in
+        :param reader:                 An asyncio StreamReader to read the selection from
+        :param writer:                 An asyncio StreamWriter to write the prompt to
+        :raise EOFError:               If the input has been exhausted
+        :return:                       A user selection
+        """
+
+        if not menu._hooks:
+            return await menu.get_selection_async(reader, writer)
+
+        menu._fire("pre_selection", menu)
+        start     = time.perf_counter()
+        selection = await menu.get_selection_async(reader, writer)
+        menu._fire("post_selection", menu, selection, time.perf_counter() - start)
+
+        return selection
+
+    def _get_target(self, option_fx):
+        """
+        Works out which menu an option function navigates to, if any. The
+        Menu methods run, nav_parent and nav_child are treated as navigation,
+        as are LazyMenu objects, which build their menu on first use.
+        :param option_fx:              An option function
+        :raise MenuNavigateError:      If the target menu does not exist
+        :return:                       The target Menu object, or None
+        """
+
+        return _nav_target(option_fx, build=True, strict=True)
+
+    def _no_match(self, menu, selection):
+        """
+        Creates the error for a selection that does not resolve, including
+        any candidate selectors
+        :param menu:                   The Menu object the selection was made in
+        :param selection:              The user selection
+        :return:                       A MenuOptionError object
+        """
+
+        hint = menu.get_hint(selection)
+        if hint:
+            return MenuOptionError("Selection is ambiguous. " + hint)
+        else:
+            return MenuOptionError("Selection does not match a menu option")
+
+    def _print_menu(self, menu, writer=None):
+        """
+        Prints a menu, calling the menu render hooks around it
+        :param menu:                   The Menu object to print
+        :param writer:                 An asyncio StreamWriter to write to instead of stdout
+        :return:                       Nothing
+        """
+
+        hooks = menu._hooks
+        if hooks:
+            menu._fire("pre_render", menu)
+            start = time.perf_counter()
+
+        if writer is None:
+            menu.print_menu()
+        else:
+            writer.write(menu.render(as_bytes=True))
+
+        if hooks:
+            menu._fire("post_render", menu, time.perf_counter() - start)
+
+    def _resolve(self, menu, selection):
+        """
+        Resolves a selection made in the current menu. A selection that
+        matches no option but contains PATH_SEP is resolved as a path,
+        relative to the current menu or, with a leading PATH_SEP, to the
+        first menu of the session. The session then moves to the menu
+        holding the option, so the option runs as if it was selected there.
+        :param menu:                   The current Menu object
+        :param selection:              A user selection
+        :return:                       A tuple of the option and its function,
+                                       or (None, None) if nothing matches
+        """
+
+        opt, option_fx = menu.resolve(selection)
+        if opt is None and PATH_SEP in selection:
+            if selection.startswith(PATH_SEP):
+                menus, opt, option_fx = self._trail[0].resolve_path(selection.lstrip(PATH_SEP))
+            else:
+                menus, opt, option_fx = menu.resolve_path(selection)
+            if menus:
+                self._enter(menus)
+
+        return opt, option_fx
+
+    def _run_chain(self, selections, steps):
+        """
+        Runs a chain of selections, appending a MenuStep for each to a list
+        as it goes, so the steps run before an option exits the program are
+        kept. The step of the option that exits holds the SystemExit.
+        :param selections:             A list of selections
+        :param steps:                  A list to append MenuStep results to
+        :return:                       Nothing
+        """
+
+        for selection in selections:
+            menu = self.get_menu()
+            try:
+                opt, option_fx = self._resolve(menu, selection)
+            except MenuError as e:
+                # Resolving a path can build lazy menus, which may fail
+                steps.append(MenuStep(menu, selection, None, None, e))
+                break
+            if opt is None:
+                steps.append(MenuStep(menu, selection, None, None, self._no_match(menu, selection)))
+                break
+
+            try:
+                result = self._dispatch(self.get_menu(), opt, option_fx)
+            except (Exception, SystemExit) as e:
+                steps.append(MenuStep(menu, selection, opt.get_id(), None, e))
+                if isinstance(e, SystemExit):
+                    raise
+                break
+            steps.append(MenuStep(menu, selection, opt.get_id(), result, None))
+
+    def _run_option(self, option_fx):
+        """
+        Runs an option function, or moves to the menu it navigates to
+        :param option_fx:              The option function to run
+        :raise MenuRuntimeError:       If there is no option function
+        :return:                       The return value of the option function
+        """
+
+        target = self._get_target(option_fx)
+        if target is not None:
+            self.navigate(target)
+            return None
+        elif option_fx:
+            return option_fx()
+        else:
+            raise MenuRuntimeError("Called menu option has no function")
+
+def dispatch(menu, selection):
+    """
+    Resolves and runs a selection against a menu without any input or
+    output, for embedding menus in other programs. Selections are matched
+    as by a running menu, including paths. An option that navigates to
+    another menu is not called; the menu it leads to is returned instead.
+    Many threads may dispatch against one shared tree. Menu options are
+    read through tables that are replaced rather than changed when a menu
+    is edited, so they are looked up without locks, with these exceptions:
+    a path index is rebuilt by the first dispatch after a menu changes; a
+    LazyMenu with a MenuCache takes the module-wide lazy menu lock on
+    every use, and any LazyMenu builds its menu under that lock, so a slow
+    build function holds up other lazy menus; and an OptionProvider may
+    refresh its snapshot. Each call gets its own option source state, so an
+    OptionPager is matched against its first page and page selections do
+    not carry over to the next call. Option functions must be safe to call
+    from several threads themselves, and must not be coroutine functions,
+    which need a session run over asyncio.
+    :param menu:                       The Menu object to make the selection in
+    :param selection:                  A selection or a path
+    :raise MenuOptionError:            If the selection does not match an option
+    :raise MenuRuntimeError:           If menu is not a Menu object
+                                       If the selected option has no function
+                                       If the option function returns a coroutine
+    :raise MenuNavigateError:          If the option navigates to a missing menu
+    :return:                           A DispatchResult of the option, the menu the
+                                       selection leaves the caller in, and the
+                                       option function's return value
+    """
+
+    if not isinstance(menu, Menu):
+        raise MenuRuntimeError("Dispatch menu is not a Menu object")
+
+    token = _SESSION.set(MenuSession(menu))
+    try:
+        opt, option_fx = menu.resolve(selection)
+        if opt is None and PATH_SEP in selection:
+            menus, opt, option_fx = menu.resolve_path(selection.lstrip(PATH_SEP))
+            if menus:
+                menu = menus[-1]
+        if opt is None:
+            raise MenuOptionError("Selection does not match a menu option")
+
+        target = _nav_target(option_fx, build=True, strict=True)
+        if target is not None:
+            return DispatchResult(opt, target, None)
+        elif not option_fx:
+            raise MenuRuntimeError("Called menu option has no function")
+
+        result = option_fx()
+    finally:
+        _SESSION.reset(token)
+
+    if inspect.iscoroutine(result):
+        result.close()
+        raise MenuRuntimeError("Called menu option is a coroutine function")
+
+    return DispatchResult(opt, menu, result)
+
+def _split_chain(line):
+    """
+    Splits an input line into the selections of a chain, dropping empty selections
+    :param line:                       A string of selections separated by CHAIN_SEP
+    :return:                           A list of selections
+    """
+
+    return [sel.strip() for sel in line.split(CHAIN_SEP) if sel.strip()]
+
+def _chain_report(steps, selections):
+    """
+    Describes where a chain of selections stopped
+    :param steps:                      The MenuStep results of the chain, ending with the failed step
+    :param selections:                 The selections of the chain
+    :return:                           A report string
+    """
+
+    step = steps[-1]
+    return "Chain stopped at step %d of %d (%s in %s): %s" % (
+        len(steps), len(selections), step.selection, step.menu.get_prompt(), step.error)
+
+def _iter_menus(menu):
+    """
+    Iterates over a menu and every menu reachable from it through child
+    menus or options that run another menu
+    :param menu:                       The Menu object to start from
+    :return:                           An iterator of Menu objects
+    """
+
+    seen  = set()
+    stack = [menu]
+    while stack:
+        menu = stack.pop()
+        if id(menu) in seen:
+            continue
+        seen.add(id(menu))
+        yield menu
+
+        stack.extend(menu.get_child_menus())
+        for opt in menu.get_options():
+            owner = getattr(opt.get_fx(), '__self__', None)
+            if isinstance(owner, Menu) and getattr(opt.get_fx(), '__func__', None) is Menu.run:
+                stack.append(owner)
+
+def _tree_changed(*menus):
+    """
+    Marks the path indexes built through any of the given menus as out of date
+    :param menus:                      The Menu objects that changed
+    :return:                           Nothing
+    """
+
+    with _PATH_LOCK:
+        for menu in menus:
+            users = menu._path_users
+            if users:
+                menu._path_users = None
+                for user in users:
+                    user._paths = None
+
+def _is_ancestor(menu, node):
+    """
+    Checks if a menu is a node or above it. Levels grow by at least one from
+    a parent menu to its children, so only the parent links between the two
+    levels are followed, one step per level.
+    :param menu:                       The Menu object that may be above node
+    :param node:                       The Menu object to start from
+    :return:                           True if menu is node or above it, False otherwise
+    """
+
+    lvl = menu.get_level()
+    while node is not None and node is not menu and node.get_level() > lvl:
+        node = node.get_parent_menu()
+
+    return node is menu
+
+def _set_subtree_level(menu, lvl):
+    """
+    Sets the level of a menu, and of every menu below it to one more than
+    its parent, visiting each menu once
+    :param menu:                       The Menu object at the top of the subtree
+    :param lvl:                        The new level of menu
+    :return:                           Nothing
+    """
+
+    seen  = set()
+    stack = [(menu, lvl)]
+    while stack:
+        menu, lvl = stack.pop()
+        if menu in seen:
+            continue
+        seen.add(menu)
+        menu._lvl = lvl
+        stack.extend((child, lvl + 1) for child in menu._child_menus)
+
+def _nav_target(option_fx, build=False, strict=False):
+    """
+    Works out which menu an option function navigates to, if any
+    :param option_fx:                  An option function
+    :param build:                      Builds the menu of a LazyMenu that has not been built
+    :param strict:                     Raises an error instead of returning None when
+                                       nav_parent or nav_child has no menu to go to
+    :raise MenuNavigateError:          If strict and the target menu does not exist
+    :return:                           The target Menu object, or None
+    """
+
+    if isinstance(option_fx, LazyMenu):
+        # Without build, a built menu is read as it is, so looking over a tree
+        # neither takes the lazy menu lock nor counts as a use of the cache
+        return option_fx.get_menu() if build else option_fx._menu
+
+    menu = getattr(option_fx, '__self__', None)
+    if not isinstance(menu, Menu):
+        return None
+
+    func = getattr(option_fx, '__func__', None)
+    if func is Menu.run:
+        return menu
+    elif func is Menu.nav_parent:
+        if strict and not menu.get_parent_menu():
+            raise MenuNavigateError("Navigation failed, parent menu does not exist")
+        return menu.get_parent_menu()
+    elif func is Menu.nav_child:
+        if strict and not menu.get_child_menus():
+            raise MenuNavigateError("Navigation failed, child menu does not exist")
+        return menu.get_child_menus()[0] if menu.get_child_menus() else None
+    else:
+        return None
+
+def _build_path_index(menu):
+    """
+    Builds the index of canonical paths for the options in a menu and the
+    menus below it. Options leading to a parent menu, or to a menu already
+    indexed, are indexed but not followed.
+    :param menu:                       The Menu object to start from
+    :return:                           A tuple of a dictionary of paths to (menus, option)
+                                       tuples, where menus are the menus entered to reach
+                                       the option, and the set of menus the index depends on
+    """
+
+    index = {}
+    seen  = set([menu])
+    lazy  = set()
+    queue = collections.deque([((menu,), "")])
+    while queue:
+        menus, prefix = queue.popleft()
+        for opt in menus[-1].get_options():
+            selectors = opt.get_selectors()
+            if not selectors:
+                continue
+            path = prefix + max(selectors, key=len)
+            index.setdefault(path, (menus, opt))
+
+            fx     = opt.get_fx()
+            target = _nav_target(fx)
+            if target is not None and target not in seen and target is not menus[-1].get_parent_menu():
+                seen.add(target)
+                queue.append((menus + (target,), path + PATH_SEP))
+            elif target is None and isinstance(fx, LazyMenu):
+                # Building the menu adds it to its parent, which then drops this index
+                lazy.add(fx._parent)
+
+    return index, seen | lazy
+
+class ConnectionStats(object):
+
+    def __init__(self, peer=None):
+        """
+        Creates throughput and latency counters for one server connection
+        :param peer:                   The address of the connected client
+        :return:                       A new ConnectionStats object
+        """
+
+        self._peer        = peer
+        self._opened      = time.time()
+        self._closed      = None
+        self._inputs      = 0
+        self._selections  = 0
+        self._latency     = 0.0
+        self._max_latency = 0.0
+
+    def close(self):
+        """
+        Marks the connection as closed
+        :return:                       Nothing
+        """
+
+        self._closed = time.time()
+
+    def record_input(self):
+        """
+        Records a line read from the client, whether or not it resolves
+        :return:                       Nothing
+        """
+
+        self._inputs += 1
+
+    def record(self, latency):
+        """
+        Records a handled selection
+        :param latency:                Seconds taken to handle the selection
+        :return:                       Nothing
+        """
+
+        self._selections += 1
+        self._latency    += latency
+        if latency > self._max_latency:
+            self._max_latency = latency
+
+    def get_peer(self):
+        """
+        Retrieves the address of the connected client
+        :return:                       A peer address, or None if unknown
+        """
+
+        return self._peer
+
+    def get_inputs(self):
+        """
+        Retrieves the number of lines read from the client
+        :return:                       A line count
+        """
+
+        return self._inputs
+
+    def get_selections(self):
+        """
+        Retrieves the number of selections handled on the connection
+        :return:                       A selection count
+        """
+
+        return self._selections
+
+    def get_throughput(self):
+        """
+        Retrieves the selections handled per second while the connection was open
+        :return:                       Selections per second
+        """
+
+        elapsed = (self._closed or time.time()) - self._opened
+        return self._selections / elapsed if elapsed > 0 else 0.0
+
+    def get_mean_latency(self):
+        """
+        Retrieves the mean time taken to handle a selection
+        :return:                       Mean latency in seconds
+        """
+
+        return self._latency / self._selections if self._selections else 0.0
+
+    def get_max_latency(self):
+        """
+        Retrieves the longest time taken to handle a selection
+        :return:                       Maximum latency in seconds
+        """
+
+        return self._max_latency
+
+    def as_dict(self):
+        """
+        Retrieves the connection counters as a dictionary
+        :return:                       A dictionary of connection counters
+        """
+
+        return {
+            "peer":         self._peer,
+            "opened":       self._opened,
+            "closed":       self._closed,
+            "inputs":       self._inputs,
+            "selections":   self._selections,
+            "throughput":   self.get_throughput(),
+            "mean_latency": self.get_mean_latency(),
+            "max_latency":  self._max_latency,
+        }
+
+class _BufferWriter(object):
+    """Collects output written by a session, standing in for an asyncio StreamWriter"""
+
+    def __init__(self):
+        """
+        Creates an empty output buffer
+        :return:                       A new _BufferWriter object
+        """
+
+        self._buf    = bytearray()
+        self._closed = False
+
+    def write(self, data):
+        """
+        Appends output to the buffer
+        :param data:                   The bytes written
+        :return:                       Nothing
+        """
+
+        self._buf.extend(data)
+
+    async def drain(self):
+        """
+        Waits for written output to be sent, which a buffer never needs to
+        :return:                       Nothing
+        """
+
+        pass
+
+    def close(self):
+        """
+        Marks the writer closed. The output stays readable.
+        :return:                       Nothing
+        """
+
+        self._closed = True
+
+    async def wait_closed(self):
+        """
+        Waits for the writer to close, which a buffer does at once
+        :return:                       Nothing
+        """
+
+        pass
+
+    def is_closing(self):
+        """
+        Checks if the writer has been closed
+        :return:                       True if close has been called, False otherwise
+        """
+
+        return self._closed
+
+    def get_extra_info(self, name, default=None):
+        """
+        Retrieves transport information, which a buffer does not have
+        :param name:                   The name of the information, such as "peername"
+        :param default:                The value to return
+        :return:                       The default value
+        """
+
+        return default
+
+    def getvalue(self):
+        """
+        Retrieves the output written so far
+        :return:                       The output bytes
+        """
+
+        return bytes(self._buf)
+
+class MenuServer(object):
+
+    def __init__(self, menu):
+        """
+        Creates a server that runs a menu tree for many clients at once.
+        The tree is shared by every connection and treated as read-only:
+        navigation state lives in a MenuSession per connection. The dispatch
+        tables and menu text for the whole tree are compiled up front so
+        that connections only ever read from the menus.
+        :param menu:                   The root Menu object to serve
+        :raise MenuRuntimeError:       If menu is not a Menu object
+        :return:                       A new MenuServer object
+        """
+
+        if not isinstance(menu, Menu):
+            raise MenuRuntimeError("Server menu is not a Menu object")
+
+        for m in _iter_menus(menu):
+            m.get_dispatch_table()
+            m.render()
+
+        self._menu   = menu
+        self._active = {}
+        self._closed = collections.deque(maxlen=SERVER_HISTORY)
+        self._server = None
+
+    async def handle(self, reader, writer):
+        """
+        Serves one client connection until it disconnects or exits. An option
+        that fails, or a selection whose path fails to resolve, is reported
+        to the client and the session carries on from the same menu. An
+        error raised before a line is read from the client, such as
+        reaching a menu with no options, moves the session back to the
+        previous menu, or ends the connection if there is none.
+        :param reader:                 An asyncio StreamReader for the client
+        :param writer:                 An asyncio StreamWriter for the client
+        :return:                       The ConnectionStats for the connection
+        """
+
+        session = MenuSession(self._menu)
+        stats   = ConnectionStats(writer.get_extra_info("peername"))
+        self._active[id(stats)] = stats
+        try:
+            while True:
+                inputs = stats.get_inputs()
+                try:
+                    await session.run_async(reader, writer, stats)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break
+                except Exception as e:
+                    writer.write(("Error: %s\n" % e).encode())
+
+                # Restarting straight away would fail again without waiting for the client
+                menu = session.get_menu()
+                if stats.get_inputs() == inputs or not (menu.get_options() or menu.get_option_sources()):
+                    trail = session.get_trail()
+                    if len(trail) < 2:
+                        break
+                    session.navigate(trail[-2])
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    break
+        finally:
+            stats.close()
+            del self._active[id(stats)]
+            self._closed.append(stats)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+        return stats
+
+    async def start(self, host="127.0.0.1", port=0, path=None, backlog=SERVER_BACKLOG):
+        """
+        Starts listening for clients on a TCP port, or a Unix-domain socket
+        if a path is given
+        :param host:                   The TCP address to listen on
+        :param port:                   The TCP port to listen on, 0 picks a free port
+        :param path:                   The Unix-domain socket path to listen on
+        :param backlog:                The number of pending connections to queue
+        :raise MenuRuntimeError:       If the server is already started
+        :return:                       The asyncio Server object
+        """
+
+        if self._server:
+            raise MenuRuntimeError("Server is already started")
+        elif path:
+            self._server = await asyncio.start_unix_server(self.handle, path=path,
+                                                           backlog=backlog)
+        else:
+            self._server = await asyncio.start_server(self.handle, host, port,
+                                                      backlog=backlog)
+
+        return self._server
+
+    async def serve_forever(self, host="127.0.0.1", port=0, path=None, backlog=SERVER_BACKLOG):
+        """
+        Starts the server and handles clients until cancelled
+        :param host:                   The TCP address to listen on
+        :param port:                   The TCP port to listen on, 0 picks a free port
+        :param path:                   The Unix-domain socket path to listen on
+        :param backlog:                The number of pending connections to queue
+        :return:                       Nothing
+        """
+
+        server = await self.start(host, port, path, backlog)
+        async with server:
+            await server.serve_forever()
+
+    async def stop(self):
+        """
+        Stops listening for new clients
+        :return:                       Nothing
+        """
+
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def run_local(self, selections):
+        """
+        Runs one in-process client connection from a list of selections,
+        without opening a socket. Useful for testing a served menu tree.
+        :param selections:             A list of selections, or a string of
+                                       newline separated selections
+        :return:                       A tuple of the output text and the ConnectionStats
+        """
+
+        if not isinstance(selections, str):
+            selections = "\n".join(selections) + "\n"
+
+        reader = asyncio.StreamReader()
+        reader.feed_data(selections.encode())
+        reader.feed_eof()
+        writer = _BufferWriter()
+        stats  = await self.handle(reader, writer)
+
+        return writer.getvalue().decode(), stats
+
+    def get_stats(self):
+        """
+        Retrieves the counters for open connections and recently closed ones
+        :return:                       A list of ConnectionStats objects
+        """
+
+        return list(self._closed) + list(self._active.values())
+
+def serve(menu, host="127.0.0.1", port=0, path=None):
+    """
+    Serves a menu tree to many clients over TCP or a Unix-domain socket
+    until interrupted
+    :param menu:                       The root Menu object to serve
+    :param host:                       The TCP address to listen on
+    :param port:                       The TCP port to listen on
+    :param path:                       The Unix-domain socket path to listen on
+    :return:                           Nothing
+    """
+
+    asyncio.run(MenuServer(menu).serve_forever(host, port, path))
+
+class MenuCache(object):
+
+    def __init__(self, max_size=MENU_CACHE_SIZE, ttl=None):
+        """
+        Creates a least recently used cache for menus built by LazyMenu
+        objects. Once more than max_size menus are built, or a menu is older
+        than ttl seconds, the menu is evicted: it is removed from its parent's
+        child menus and built again the next time it is navigated to.
+        :param max_size:               The number of built menus to keep
+        :param ttl:                    Seconds a built menu is kept, or None to keep it
+        :raise MenuCreateError:        If max_size is not a positive integer
+                                       If ttl is not a positive number
+        :return:                       A new MenuCache object
+        """
+
+        if not isinstance(max_size, int) or max_size < 1:
+            raise MenuCreateError("Cache size is not a positive integer")
+        elif ttl is not None and (not isinstance(ttl, (int, float)) or ttl <= 0):
+            raise MenuCreateError("Cache ttl is not a positive number")
+        else:
+            self._entries   = collections.OrderedDict()
+            self._max_size  = max_size
+            self._ttl       = ttl
+            self._evictions = 0
+
+    def add(self, lazy):
+        """
+        Records a newly built menu, evicting the least recently used
+        menus if the cache is full
+        :param lazy:                   The LazyMenu object that built the menu
+        :return:                       Nothing
+        """
+
+        with _LAZY_LOCK:
+            self._entries[lazy] = time.monotonic()
+            self._entries.move_to_end(lazy)
+            while len(self._entries) > self._max_size:
+                self.evict(next(iter(self._entries)))
+
+    def touch(self, lazy):
+        """
+        Marks a built menu as recently used
+        :param lazy:                   The LazyMenu object that built the menu
+        :return:                       False if the menu has expired, True otherwise
+        """
+
+        with _LAZY_LOCK:
+            built = self._entries.get(lazy)
+            if built is None:
+                return False
+            elif self._ttl is not None and time.monotonic() - built > self._ttl:
+                return False
+            self._entries.move_to_end(lazy)
+            return True
+
+    def evict(self, lazy):
+        """
+        Evicts a built menu from the cache and unlinks it from its parent
+        :param lazy:                   The LazyMenu object that built the menu
+        :return:                       Nothing
+        """
+
+        with _LAZY_LOCK:
+            if self._entries.pop(lazy, None) is not None:
+                self._evictions += 1
+            lazy._unload()
+
+    def clear(self):
+        """
+        Evicts every built menu from the cache
+        :return:                       Nothing
+        """
+
+        with _LAZY_LOCK:
+            while self._entries:
+                self.evict(next(iter(self._entries)))
+
+    def get_size(self):
+        """
+        Retrieves the number of built menus in the cache
+        :return:                       A menu count
+        """
+
+        return len(self._entries)
+
+    def get_evictions(self):
+        """
+        Retrieves the number of menus evicted from the cache
+        :return:                       An eviction count
+        """
+
+        return self._evictions
+
+class LazyMenu(object):
+
+    __slots__ = ("_parent", "_build", "_cache", "_menu", "_hooks")
+
+    def __init__(self, parent, build, cache=None):
+        """
+        Creates a placeholder for a child menu that is only built the first
+        time it is navigated to. Use the LazyMenu as the function of the
+        option that leads to the child menu.
+        :param parent:                 The parent Menu object
+        :param build:                  A function that returns the child Menu object
+        :param cache:                  A MenuCache that may evict the built menu
+        :raise MenuCreateError:        If parent is not a Menu object
+                                       If build is not callable
+                                       If cache is not a MenuCache object
+        :return:                       A new LazyMenu object
+        """
+
+        if not isinstance(parent, Menu):
+            raise MenuCreateError("Lazy menu parent is not a Menu object")
+        elif not hasattr(build, '__call__'):
+            raise MenuCreateError("Lazy menu build function is not callable")
+        elif cache is not None and not isinstance(cache, MenuCache):
+            raise MenuCreateError("Lazy menu cache is not a MenuCache object")
+        else:
+            self._parent = parent
+            self._build  = build
+            self._cache  = cache
+            self._menu   = None
+            self._hooks  = ()
+
+    def __call__(self):
+        """
+        Runs the child menu, building it first if needed
+        :return:                       Nothing
+        """
+
+        self.get_menu().run()
+
+    def add_build_hook(self, fx):
+        """
+        Adds a function that is called with each child menu the LazyMenu
+        builds, including menus built again after an eviction. It is called
+        after the menu is linked to its parent, outside the lazy menu lock.
+        :param fx:                     The function to call
+        :raise MenuEditError:          If fx is not callable
+        :return:                       Nothing
+        """
+
+        if not hasattr(fx, '__call__'):
+            raise MenuEditError("Lazy menu build hook is not callable")
+        else:
+            self._hooks = self._hooks + (fx,)
+
+    def get_menu(self):
+        """
+        Retrieves the child menu, building it and linking it to its
+        parent if it has not been built or has been evicted
+        :raise MenuCreateError:        If the build function does not return a Menu object
+        :return:                       The child Menu object
+        """
+
+        menu = self._menu
+        if menu is not None and self._cache is None:
+            return menu
+
+        built = False
+        with _LAZY_LOCK:
+            menu = self._menu
+            if menu is not None and self._cache and not self._cache.touch(self):
+                self._cache.evict(self)
+                menu = None
+
+            if menu is None:
+                menu = self._build()
+                if not isinstance(menu, Menu):
+                    raise MenuCreateError("Lazy menu build did not return a Menu object")
+                self._parent.add_child_menu(menu, menu.get_parent_menu() is not self._parent)
+                self._menu = menu
+                built = True
+                if self._cache:
+                    self._cache.add(self)
+
+        if built:
+            for fx in self._hooks:
+                fx(menu)
+
+        return menu
+
+    def is_built(self):
+        """
+        Checks if the child menu has been built
+        :return:                       True if the menu has been built, False otherwise
+        """
+
+        return self._menu is not None
+
+    def remove_build_hook(self, fx):
+        """
+        Removes a build hook from a LazyMenu
+        :param fx:                     The hook function to remove
+        :raise MenuEditError:          If the hook was not added
+        :return:                       Nothing
+        """
+
+        if fx not in self._hooks:
+            raise MenuEditError("Lazy menu build hook does not exist")
+        else:
+            hooks = list(self._hooks)
+            hooks.remove(fx)
+            self._hooks = tuple(hooks)
+
+    def _unload(self):
+        """
+        Drops the built child menu and removes it from its parent's child
+        menus. The child keeps its link to the parent, so sessions still in
+        the evicted menu can navigate back.
+        :return:                       Nothing
+        """
+
+        menu, self._menu = self._menu, None
+        if menu is not None and menu in self._parent.get_child_menus():
+            self._parent.remove_child_menu(menu, unlink_parent=False)
+
+def _import_fx(name, cache):
+    """
+    Imports an option function from a dotted name such as "package.module.function"
+    :param name:                       The dotted name of the function
+    :param cache:                      A dictionary of names already imported
+    :raise MenuCreateError:            If the function cannot be imported or is not callable
+    :return:                           The option function
+    """
+
+    fx = cache.get(name)
+    if fx is not None:
+        return fx
+
+    parts = name.split(".")
+    for split in range(len(parts) - 1, 0, -1):
+        try:
+            fx = importlib.import_module(".".join(parts[:split]))
+        except ImportError:
+            continue
+        try:
+            for attr in parts[split:]:
+                fx = getattr(fx, attr)
+        except AttributeError:
+            raise MenuCreateError("Option function %s does not exist" % name)
+        break
+    else:
+        raise MenuCreateError("Option function %s cannot be imported" % name)
+
+    if not hasattr(fx, '__call__'):
+        raise MenuCreateError("Option function %s is not callable" % name)
+    cache[name] = fx
+
+    return fx
+
+def validate_menu_spec(spec):
+    """
+    Checks a whole menu tree specification in one pass, without building
+    any menus or importing any option functions. A menu specification is
+    a dictionary with an optional "prompt" string, an optional "back"
+    flag that adds an option to navigate to the parent menu, and a list
+    of "options". Each option is a dictionary with an "id", optional
+    "text" and "selectors", and either an "fx" dotted function name or
+    a "menu" holding the specification of a child menu.
+    :param spec:                       A menu specification dictionary
+    :raise MenuCreateError:            If any part of the specification is invalid
+    :return:                           Nothing
+    """
+
+    stack = [(spec, "menu", MENU_ROOT)]
+    while stack:
+        spec, where, lvl = stack.pop()
+        if not isinstance(spec, dict):
+            raise MenuCreateError("%s is not a dictionary" % where)
+        elif not isinstance(spec.get("prompt", ""), str):
+            raise MenuCreateError("%s prompt is not a string" % where)
+        elif not isinstance(spec.get("options"), list):
+            raise MenuCreateError("%s options is not a list" % where)
+        elif spec.get("back") and lvl == MENU_ROOT:
+            raise MenuCreateError("%s back for MENU_ROOT level menu" % where)
+
+        ids  = set()
+        sels = set()
+        if spec.get("back"):
+            ids.add(OPT_ID_NAVP)
+            sels.update(("b", "back"))
+        for idx, opt in enumerate(spec["options"]):
+            opt_where = "%s option %d" % (where, idx)
+            if not isinstance(opt, dict):
+                raise MenuCreateError("%s is not a dictionary" % opt_where)
+
+            opt_id    = opt.get("id")
+            selectors = opt.get("selectors", [])
+            fx        = opt.get("fx")
+            if not isinstance(opt_id, int) or opt_id <= OPT_ID_NULL:
+                raise MenuCreateError("%s id is not a positive integer" % opt_where)
+            elif opt_id in ids:
+                raise MenuCreateError("%s id already exists" % opt_where)
+            elif not isinstance(opt.get("text", ""), str):
+                raise MenuCreateError("%s text is not a string" % opt_where)
+            elif not isinstance(selectors, list) or [s for s in selectors if not isinstance(s, str)]:
+                raise MenuCreateError("%s selectors is not a list of strings" % opt_where)
+            elif sels.intersection(selectors):
+                raise MenuCreateError("%s selector already exists" % opt_where)
+            elif fx is not None and "menu" in opt:
+                raise MenuCreateError("%s has both a function and a menu" % opt_where)
+            elif fx is not None and (not isinstance(fx, str) or "." not in fx):
+                raise MenuCreateError("%s function is not a dotted name" % opt_where)
+
+            ids.add(opt_id)
+            sels.update(selectors)
+            if "menu" in opt:
+                stack.append((opt["menu"], opt_where + " menu", lvl + 1))
+
+def _build_menu(spec, lvl, fx_cache, cache):
+    """
+    Builds one menu from a validated specification. Child menus are
+    represented by LazyMenu objects and built when first navigated to.
+    :param spec:                       A validated menu specification dictionary
+    :param lvl:                        The level for the new menu
+    :param fx_cache:                   A dictionary of option functions already imported
+    :param cache:                      A MenuCache for the child menus, or None
+    :return:                           A new Menu object
+    """
+
+    menu = Menu(spec.get("prompt", "Menu>"), lvl, add_back=bool(spec.get("back")))
+    opts = []
+    for opt in spec["options"]:
+        if "menu" in opt:
+            fx = LazyMenu(menu, lambda child=opt["menu"]: _build_menu(child, lvl + 1, fx_cache, cache),
+                          cache)
+        elif opt.get("fx"):
+            fx = _import_fx(opt["fx"], fx_cache)
+        else:
+            fx = None
+        opts.append(MenuOption(opt["id"], opt.get("text", ""), opt.get("selectors", ()), fx))
+    menu.add_options(opts)
+
+    return menu
+
+def load_menu(spec, cache=None):
+    """
+    Builds a menu tree from a specification dictionary, as described by
+    validate_menu_spec. The whole specification is validated up front,
+    but only the root menu is built: each child menu, and the option
+    functions it imports, is only built the first time it is navigated to.
+    :param spec:                       A menu specification dictionary
+    :param cache:                      A MenuCache bounding how many child menus stay built
+    :raise MenuCreateError:            If the specification is invalid
+                                       If an option function cannot be imported
+    :return:                           The root Menu object
+    """
+
+    validate_menu_spec(spec)
+
+    return _build_menu(spec, MENU_ROOT, {}, cache)
+
+def load_menu_file(path, cache=None):
+    """
+    Builds a menu tree from a JSON file holding a menu specification
+    :param path:                       The path to the JSON file
+    :param cache:                      A MenuCache bounding how many child menus stay built
+    :raise MenuCreateError:            If the specification is invalid
+                                       If an option function cannot be imported
+    :return:                           The root Menu object
+    """
+
+    with open(path) as f:
+        spec = json.load(f)
+
+    return load_menu(spec, cache)
+
+def _import_ref(ref, cache):
+    """
+    Imports an option function from a reference such as "package.module:Class.function"
+    :param ref:                        The module and qualified name of the function
+    :param cache:                      A dictionary of references already imported
+    :raise MenuCreateError:            If the function cannot be imported
+    :return:                           The option function
+    """
+
+    fx = cache.get(ref)
+    if fx is not None:
+        return fx
+
+    module, _, qualname = ref.partition(":")
+    try:
+        fx = importlib.import_module(module)
+        for attr in qualname.split("."):
+            fx = getattr(fx, attr)
+    except (ImportError, AttributeError, ValueError):
+        raise MenuCreateError("Option function %s cannot be imported" % ref)
+    cache[ref] = fx
+
+    return fx
+
+def _collect_menus(menu):
+    """
+    Collects every menu linked to a menu through parent, child and
+    navigation links, building the menus of LazyMenu objects
+    :param menu:                       The Menu object to start from
+    :raise MenuCreateError:            If a menu has option sources
+    :return:                           A tuple of a list of Menu objects, starting with
+                                       menu, and a dictionary of Menu objects to positions
+    """
+
+    menus = [menu]
+    index = {menu: 0}
+    pos   = 0
+    while pos < len(menus):
+        current = menus[pos]
+        pos    += 1
+        if current.get_option_sources():
+            raise MenuCreateError("Menu option sources cannot be copied")
+
+        linked = list(current.get_child_menus())
+        linked.append(current.get_parent_menu())
+        for opt in current.get_options():
+            fx = opt.get_fx()
+            linked.append(fx.get_menu() if isinstance(fx, LazyMenu) else getattr(fx, '__self__', None))
+        for m in linked:
+            if isinstance(m, Menu) and m not in index:
+                index[m] = len(menus)
+                menus.append(m)
+
+    return menus, index
+
+def _menu_method(fx):
+    """
+    Works out which Menu navigation method an option function is
+    :param fx:                         An option function
+    :return:                           A tuple of the Menu object and the method name,
+                                       or None if fx is not a navigation method. A
+                                       LazyMenu is reported as run on its built menu.
+    """
+
+    if isinstance(fx, LazyMenu):
+        return fx.get_menu(), "run"
+
+    owner = getattr(fx, '__self__', None)
+    if isinstance(owner, Menu):
+        for name in _SNAPSHOT_METHODS:
+            if getattr(fx, '__func__', None) is getattr(Menu, name):
+                return owner, name
+
+    return None
+
+def _fx_ref(fx, index):
+    """
+    Creates the reference stored in a compiled menu snapshot for an option function
+    :param fx:                         The option function
+    :param index:                      A dictionary of Menu objects to snapshot menu indexes
+    :raise MenuCreateError:            If the function cannot be imported by reference
+    :return:                           None, a [method, menu index] list for a Menu
+                                       method, or a "module:qualname" string
+    """
+
+    if fx is None:
+        return None
+
+    method = _menu_method(fx)
+    if method:
+        return [method[1], index[method[0]]]
+
+    module   = getattr(fx, '__module__', None)
+    qualname = getattr(fx, '__qualname__', None)
+    if module and qualname and "<" not in qualname:
+        ref = module + ":" + qualname
+        try:
+            if _import_ref(ref, {}) is fx:
+                return ref
+        except MenuCreateError:
+            pass
+
+    raise MenuCreateError("Option function %r cannot be imported by reference" % (fx,))
+
+def compile_menu(menu, path=None, key=None):
+    """
+    Compiles a menu tree into a snapshot that load_compiled_menu can turn
+    back into menus without validating or indexing them again. The
+    snapshot holds every menu connected to menu through parent, child and
+    navigation links, with their options, selectors, levels and matching
+    settings. Option functions are stored as importable "module:qualname"
+    references, so they must be module level functions or class attributes.
+    Child menus built by LazyMenu objects are built and stored as plain menus.
+    :param menu:                       The Menu object to compile, loaded back as the root
+    :param path:                       A file to write the snapshot to
+    :param key:                        A JSON value stored in the snapshot, such as the
+                                       version of the code building the tree, that
+                                       must match when the snapshot is loaded
+    :raise MenuCreateError:            If a menu has option sources
+                                       If an option function cannot be imported by reference
+    :return:                           The snapshot text
+    """
+
+    menus, index = _collect_menus(menu)
+
+    # Each option function is stored once and options refer to it by position
+    refs    = []
+    ref_ids = {}
+    records = []
+    for m in menus:
+        options = []
+        for o in m.get_options():
+            fx = o.get_fx()
+            try:
+                ref_id = ref_ids.get(fx)
+            except TypeError:
+                ref_id = None
+            if ref_id is None:
+                ref_id = len(refs)
+                refs.append(_fx_ref(fx, index))
+                try:
+                    ref_ids[fx] = ref_id
+                except TypeError:
+                    pass
+            options.append([o.get_id(), o.get_text(), list(o.get_selectors()), ref_id])
+
+        records.append({
+            "prompt":   m.get_prompt(),
+            "lvl":      m.get_level(),
+            "parent":   index.get(m.get_parent_menu()),
+            "children": [index[c] for c in m.get_child_menus()],
+            "matching": [m._prefix, m._fuzzy],
+            "options":  options,
+        })
+
+    payload = json.dumps({"key": key, "functions": refs, "menus": records}, separators=(",", ":"))
+    header  = json.dumps({"format": SNAPSHOT_FORMAT, "sha256": hashlib.sha256(payload.encode()).hexdigest()})
+    text    = header + "\n" + payload
+
+    if path is not None:
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    return text
+
+def load_compiled_menu(snapshot, key=None):
+    """
+    Loads a menu tree compiled by compile_menu. The snapshot is checked
+    against its content hash, then the menus, their option indexes and
+    their dispatch tables are filled in directly, skipping the checks
+    made when options are added one by one. Garbage collection is paused
+    while the objects are created, since none of them can be garbage yet.
+    :param snapshot:                   The snapshot text, or the path to a snapshot file
+    :param key:                        The key the snapshot was compiled with
+    :raise MenuCreateError:            If the snapshot is corrupt, out of date or for another key
+                                       If an option function cannot be imported
+    :return:                           The root Menu object
+    """
+
+    if "\n" not in snapshot:
+        with open(snapshot) as f:
+            snapshot = f.read()
+
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return _load_snapshot(snapshot, key)
+    finally:
+        if collecting:
+            gc.enable()
+
+def _load_snapshot(snapshot, key):
+    """
+    Loads a menu tree from the text of a compiled snapshot, see load_compiled_menu
+    :param snapshot:                   The snapshot text
+    :param key:                        The key the snapshot was compiled with
+    :raise MenuCreateError:            If the snapshot is corrupt, out of date or for another key
+                                       If an option function cannot be imported
+    :return:                           The root Menu object
+    """
+
+    header, _, payload = snapshot.partition("\n")
+    try:
+        header = json.loads(header)
+        if header.get("format") != SNAPSHOT_FORMAT:
+            raise MenuCreateError("Menu snapshot format is not supported")
+        elif header.get("sha256") != hashlib.sha256(payload.encode()).hexdigest():
+            raise MenuCreateError("Menu snapshot does not match its content hash")
+        payload = json.loads(payload)
+    except (ValueError, AttributeError):
+        raise MenuCreateError("Menu snapshot is not valid")
+    if payload.get("key") != key:
+        raise MenuCreateError("Menu snapshot was compiled for another key")
+
+    records = payload["menus"]
+    menus   = [Menu(r["prompt"], r["lvl"]) for r in records]
+    fxs     = []
+    for ref in payload["functions"]:
+        if ref is None:
+            fxs.append(None)
+        elif isinstance(ref, list) and ref[0] in _SNAPSHOT_METHODS:
+            fxs.append(getattr(menus[ref[1]], ref[0]))
+        elif isinstance(ref, list):
+            raise MenuCreateError("Menu snapshot option function %s is not valid" % ref[0])
+        else:
+            fxs.append(_import_ref(ref, {}))
+
+    for menu, r in zip(menus, records):
+        options   = []
+        opt_index = {}
+        sel_index = {}
+        table     = {}
+        for id, text, selectors, ref_id in r["options"]:
+            fx  = fxs[ref_id]
+            opt = MenuOption.__new__(MenuOption)
+            opt._id        = id
+            opt._text      = text
+            opt._selectors = tuple(selectors)
+            opt._fx        = fx
+            options.append(opt)
+            opt_index[id] = opt
+            for sel in opt._selectors:
+                sel_index[sel] = opt
+                table[sel]     = fx
+
+        menu._options     = options
+        menu._opt_index   = opt_index
+        menu._sel_index   = sel_index
+        menu._dispatch    = types.MappingProxyType(table)
+        menu._child_menus = [menus[i] for i in r["children"]]
+        if r["parent"] is not None:
+            menu._parent_menu = menus[r["parent"]]
+        if r["matching"][0] or r["matching"][1]:
+            menu.set_matching(r["matching"][0], r["matching"][1])
+
+    return menus[0]
+
+def cached_menu(path, build, key=None):
+    """
+    Retrieves a menu tree from a compiled snapshot file, building and
+    compiling it first if the file is missing, corrupt or was compiled for
+    another key. Launches after the first one skip building the tree.
+    :param path:                       The path to the snapshot file
+    :param build:                      A function that builds and returns the root Menu object
+    :param key:                        A JSON value identifying the tree, see compile_menu
+    :raise MenuCreateError:            If build does not return a Menu object
+                                       If the built tree cannot be compiled
+    :return:                           The root Menu object
+    """
+
+    try:
+        return load_compiled_menu(path, key)
+    except (OSError, MenuCreateError):
+        pass
+
+    menu = build()
+    if not isinstance(menu, Menu):
+        raise MenuCreateError("Menu build did not return a Menu object")
+    compile_menu(menu, path, key)
+
+    return menu
+
+class MenuJob(object):
+
+    __slots__ = ("_id", "_name", "_future", "_submitted")
+
+    def __init__(self, id, name, future):
+        """
+        Creates a handle for an option function running in the background
+        :param id:                     The job id
+        :param name:                   A name for the job
+        :param future:                 The concurrent.futures Future running the job
+        :return:                       A new MenuJob object
+        """
+
+        self._id        = id
+        self._name      = name
+        self._future    = future
+        self._submitted = time.time()
+
+    def __str__(self):
+        """
+        Describes a job for the jobs menu
+        :return:                       A string with the job id, name and status
+        """
+
+        return "Job %d (%s): %s" % (self._id, self._name, self.get_status())
+
+    def get_id(self):
+        """
+        Retrieves the id for a job
+        :return:                       A job id
+        """
+
+        return self._id
+
+    def get_name(self):
+        """
+        Retrieves the name for a job
+        :return:                       A job name
+        """
+
+        return self._name
+
+    def get_status(self):
+        """
+        Retrieves the status for a job
+        :return:                       One of "pending", "running", "cancelled", "failed" or "done"
+        """
+
+        future = self._future
+        if future.cancelled():
+            return "cancelled"
+        elif future.running():
+            return "running"
+        elif not future.done():
+            return "pending"
+        elif future.exception() is not None:
+            return "failed"
+        else:
+            return "done"
+
+    def done(self):
+        """
+        Checks if a job has finished, failed or been cancelled
+        :return:                       True if the job is over, False otherwise
+        """
+
+        return self._future.done()
+
+    def cancel(self):
+        """
+        Cancels a job that has not started yet
+        :return:                       True if the job was cancelled, False otherwise
+        """
+
+        return self._future.cancel()
+
+    def get_error(self):
+        """
+        Retrieves the exception raised by a failed job
+        :return:                       An exception, or None if the job has not failed
+        """
+
+        future = self._future
+        if future.done() and not future.cancelled():
+            return future.exception()
+        else:
+            return None
+
+    def result(self, timeout=None):
+        """
+        Waits for a job and retrieves its result
+        :param timeout:                Seconds to wait, or None to wait until the job is over
+        :raise TimeoutError:           If the job is not over in time
+        :raise CancelledError:         If the job was cancelled
+        :return:                       The return value of the option function,
+                                       raising its exception if it failed
+        """
+
+        return self._future.result(timeout)
+
+class _BackgroundFx(object):
+    """An option function that submits another function to a JobManager"""
+
+    __slots__ = ("_jobs", "_fx", "_pool", "_name")
+
+    def __init__(self, jobs, fx, pool, name):
+        """
+        Creates an option function that runs fx as a background job
+        :param jobs:                   The JobManager object to submit to
+        :param fx:                     The function to run
+        :param pool:                   "thread" or "process"
+        :param name:                   The name the job is listed under
+        :return:                       A new _BackgroundFx object
+        """
+
+        self._jobs = jobs
+        self._fx   = fx
+        self._pool = pool
+        self._name = name
+
+    def __call__(self):
+        """
+        Submits the job
+        :return:                       The MenuJob object, or the reason it was refused
+        """
+
+        try:
+            return self._jobs.submit(self._fx, self._pool, self._name)
+        except MenuRuntimeError as e:
+            return str(e)
+
+class _BlockingFx(object):
+    """
+    An option function that blocks until something else finishes. A session
+    run over asyncio calls it in a worker thread instead of on the event loop.
+    """
+
+    __slots__ = ("_fx",)
+
+    def __init__(self, fx):
+        """
+        Creates an option function that calls a blocking function
+        :param fx:                     The function to call
+        :return:                       A new _BlockingFx object
+        """
+
+        self._fx = fx
+
+    def __call__(self):
+        """
+        Calls the blocking function
+        :return:                       The return value of the function
+        """
+
+        return self._fx()
+
+class JobManager(object):
+
+    def __init__(self, max_threads=JOB_THREADS, max_processes=JOB_PROCESSES, max_jobs=JOB_LIMIT):
+        """
+        Creates a manager that runs option functions in a thread pool or a
+        process pool, so slow options do not hold up the menu. The pools
+        are only started when first used. Up to JOB_HISTORY finished jobs
+        are kept until they are collected.
+        :param max_threads:            The number of worker threads
+        :param max_processes:          The number of worker processes
+        :param max_jobs:               The number of jobs allowed to be pending or running
+        :raise MenuCreateError:        If a limit is not a positive integer
+        :return:                       A new JobManager object
+        """
+
+        for limit in (max_threads, max_processes, max_jobs):
+            if not isinstance(limit, int) or limit < 1:
+                raise MenuCreateError("Job limit is not a positive integer")
+
+        self._max_threads   = max_threads
+        self._max_processes = max_processes
+        self._max_jobs      = max_jobs
+        self._threads       = None
+        self._processes     = None
+        self._jobs          = collections.OrderedDict()
+        self._finished      = collections.deque()
+        self._next_id       = 1
+        self._lock          = threading.Lock()
+
+    def background(self, fx, pool="thread", name=None):
+        """
+        Wraps an option function so that selecting the option submits it
+        as a job and returns the MenuJob straight away. Functions run in
+        the process pool must be importable module-level functions.
+        :param fx:                     The option function to run in the background
+        :param pool:                   "thread" or "process"
+        :param name:                   A name for the jobs, defaulting to the function name
+        :raise MenuOptionError:        If fx is not callable
+                                       If pool is not "thread" or "process"
+        :return:                       An option function
+        """
+
+        if not hasattr(fx, '__call__'):
+            raise MenuOptionError("Option function is not callable")
+        elif pool not in ("thread", "process"):
+            raise MenuOptionError("Job pool is not \"thread\" or \"process\"")
+
+        return _BackgroundFx(self, fx, pool, name or getattr(fx, '__name__', "job"))
+
+    def submit(self, fx, pool="thread", name=None):
+        """
+        Submits a function to run as a job
+        :param fx:                     The function to run
+        :param pool:                   "thread" or "process"
+        :param name:                   A name for the job, defaulting to the function name
+        :raise MenuRuntimeError:       If the job limit has been reached
+        :return:                       A MenuJob object
+        """
+
+        with self._lock:
+            if len(self._jobs) - len(self._finished) >= self._max_jobs:
+                raise MenuRuntimeError("Job limit reached, wait for running jobs to finish")
+
+            if pool == "process":
+                if self._processes is None:
+                    self._processes = concurrent.futures.ProcessPoolExecutor(self._max_processes)
+                executor = self._processes
+            else:
+                if self._threads is None:
+                    self._threads = concurrent.futures.ThreadPoolExecutor(self._max_threads)
+                executor = self._threads
+
+            job = MenuJob(self._next_id, name or getattr(fx, '__name__', "job"), executor.submit(fx))
+            self._jobs[job.get_id()] = job
+            self._next_id += 1
+
+        # Added outside the lock, as a job that is already over runs the callback straight away
+        job._future.add_done_callback(lambda future: self._job_done(job))
+
+        return job
+
+    def get_job(self, id):
+        """
+        Retrieves a job using its id
+        :param id:                     The job id
+        :return:                       A MenuJob object, or None if it doesn't exist
+        """
+
+        return self._jobs.get(id)
+
+    def get_jobs(self):
+        """
+        Retrieves the jobs that have not been collected
+        :return:                       List of MenuJob objects
+        """
+
+        return list(self._jobs.values())
+
+    def wait(self, timeout=None):
+        """
+        Waits for every job to be over
+        :param timeout:                Seconds to wait, or None to wait until every job is over
+        :return:                       True if every job is over, False otherwise
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for job in self.get_jobs():
+            try:
+                job.result(None if deadline is None else max(0, deadline - time.monotonic()))
+            except concurrent.futures.TimeoutError:
+                return False
+            except Exception:
+                pass
+
+        return True
+
+    async def wait_async(self, timeout=None):
+        """
+        Waits for every job to be over without blocking the event loop
+        :param timeout:                Seconds to wait, or None to wait until every job is over
+        :return:                       True if every job is over, False otherwise
+        """
+
+        futures = [asyncio.wrap_future(j._future) for j in self.get_jobs() if not j.done()]
+        if not futures:
+            return True
+
+        _, pending = await asyncio.wait(futures, timeout=timeout)
+        return not pending
+
+    def cancel(self):
+        """
+        Cancels every job that has not started yet
+        :return:                       The number of jobs cancelled
+        """
+
+        return len([j for j in self.get_jobs() if j.cancel()])
+
+    def collect(self):
+        """
+        Removes the jobs that are over from the manager
+        :return:                       List of the removed MenuJob objects
+        """
+
+        with self._lock:
+            done = [self._jobs.pop(id) for id in self._finished]
+            self._finished.clear()
+
+        return done
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker pools, cancelling jobs that have not started
+        :param wait:                   Waits for running jobs to finish
+        :return:                       Nothing
+        """
+
+        for executor in (self._threads, self._processes):
+            if executor is not None:
+                executor.shutdown(wait, cancel_futures=True)
+        self._threads   = None
+        self._processes = None
+
+    def add_jobs_menu(self, parent, id, text="[j]obs", selectors=("j", "jobs"), prompt="Jobs>"):
+        """
+        Adds a jobs menu as a child of a menu, along with the option that
+        leads to it. The jobs menu can list the jobs, wait up to JOB_WAIT
+        seconds for them, cancel jobs that have not started, and collect the
+        results of jobs that are over. Waiting in a session run over asyncio
+        does not block the event loop.
+        :param parent:                 The Menu object to add the jobs menu to
+        :param id:                     Id for the option leading to the jobs menu
+        :param text:                   Text for the option leading to the jobs menu
+        :param selectors:              Selectors for the option leading to the jobs menu
+        :param prompt:                 Prompt for the jobs menu
+        :return:                       The jobs Menu object
+        """
+
+        menu = Menu(prompt, parent.get_level() + 1, add_back=True)
+        menu.add_option(1, "[l]ist jobs", ["l", "list"], self._list_jobs)
+        menu.add_option(2, "[w]ait for jobs", ["w", "wait"], _BlockingFx(self._wait_jobs))
+        menu.add_option(3, "[c]ancel pending jobs", ["c", "cancel"], self._cancel_jobs)
+        menu.add_option(4, "[r]esults of finished jobs", ["r", "results"], self._collect_jobs)
+        parent.add_child_menu(menu)
+        parent.add_option(id, text, selectors, menu.run)
+
+        return menu
+
+    def _job_done(self, job):
+        """
+        Records a finished job, forgetting the oldest finished jobs once
+        more than JOB_HISTORY are kept
+        :param job:                    The MenuJob object that finished
+        :return:                       Nothing
+        """
+
+        with self._lock:
+            self._finished.append(job.get_id())
+            while len(self._finished) > JOB_HISTORY:
+                del self._jobs[self._finished.popleft()]
+
+    def _list_jobs(self):
+        """
+        Lists the jobs for the jobs menu
+        :return:                       A line for each job, or "No jobs"
+        """
+
+        return "\n".join([str(j) for j in self.get_jobs()]) or "No jobs"
+
+    def _wait_jobs(self):
+        """
+        Waits up to JOB_WAIT seconds for pending jobs, for the jobs menu
+        :return:                       A line for each job, see _list_jobs
+        """
+
+        self.wait(JOB_WAIT)
+        return self._list_jobs()
+
+    def _cancel_jobs(self):
+        """
+        Cancels the jobs that have not started, for the jobs menu
+        :return:                       A message with the number of jobs cancelled
+        """
+
+        return "Cancelled %d jobs" % self.cancel()
+
+    def _collect_jobs(self):
+        """
+        Collects the finished jobs and their results, for the jobs menu
+        :return:                       A line for each job, or "No finished jobs"
+        """
+
+        lines = []
+        for job in self.collect():
+            if job.get_status() == "cancelled":
+                lines.append("%s" % job)
+            elif job.get_status() == "failed":
+                lines.append("%s: %r" % (job, job.get_error()))
+            else:
+                lines.append("%s: %s" % (job, job.result()))
+
+        return "\n".join(lines) or "No finished jobs"
+
+class FanOut(object):
+
+    def __init__(self, option, targets, max_workers=FANOUT_WORKERS, timeout=None):
+        """
+        Runs an option function once per target, passing the target as the
+        only argument, on up to max_workers threads. Results can be read as
+        each target finishes and summarised once every target is done.
+        :param option:                 A MenuOption object, or the function to run
+        :param targets:                An iterable of targets
+        :param max_workers:            The number of worker threads
+        :param timeout:                Seconds a target may run before it is reported as
+                                       timed out, or None to wait for it. A timed out
+                                       target is abandoned rather than stopped.
+        :raise MenuOptionError:        If the option has no function
+                                       If max_workers is not a positive integer
+                                       If timeout is not a positive number
+        :return:                       A new FanOut object
+        """
+
+        fx = option.get_fx() if isinstance(option, MenuOption) else option
+        if not hasattr(fx, '__call__'):
+            raise MenuOptionError("Option function is not callable")
+        elif not isinstance(max_workers, int) or max_workers < 1:
+            raise MenuOptionError("Fan out workers is not a positive integer")
+        elif timeout is not None and (not isinstance(timeout, (int, float)) or timeout <= 0):
+            raise MenuOptionError("Fan out timeout is not a positive number")
+
+        self._fx          = fx
+        self._targets     = list(targets)
+        self._max_workers = max_workers
+        self._timeout     = timeout
+        self._results     = []
+        self._wall_time   = None
+
+    def results(self):
+        """
+        Runs the targets, yielding a FanOutResult as each one finishes or
+        times out. The latency of a target is measured from when a worker
+        starts it. A worker whose target times out is abandoned and another
+        worker is started in its place, so hung targets do not hold up the
+        targets queued behind them. With a timeout, the whole run is also
+        cut off after timeout seconds for each round of max_workers
+        targets, and targets that have not finished by then are reported
+        as timed out.
+        :return:                       An iterator of FanOutResult tuples
+        """
+
+        targets  = self._targets
+        timeout  = self._timeout
+        queued   = collections.deque(enumerate(targets))
+        running  = {}
+        finished = queue.Queue()
+        lock     = threading.Lock()
+        stop     = threading.Event()
+        start    = time.perf_counter()
+        deadline = None
+        if timeout is not None:
+            deadline = start + timeout * -(-len(targets) // self._max_workers)
+
+        def work():
+            while True:
+                with lock:
+                    if stop.is_set() or not queued:
+                        return
+                    key, target = queued.popleft()
+                    running[key] = time.perf_counter()
+                try:
+                    value, error = self._fx(target), None
+                except BaseException as e:
+                    value, error = None, e
+                with lock:
+                    begun = running.pop(key, None)
+                if begun is None:
+                    # Timed out and replaced by another worker
+                    return
+                finished.put(FanOutResult(target, value, error, time.perf_counter() - begun))
+
+        for _ in range(min(self._max_workers, len(targets))):
+            threading.Thread(target=work, daemon=True).start()
+
+        remaining = len(targets)
+        try:
+            while remaining:
+                wait = None
+                if timeout is not None:
+                    now = time.perf_counter()
+                    with lock:
+                        first = min(running.values(), default=now)
+                    wait = max(0, min(first + timeout, deadline) - now)
+                try:
+                    result = finished.get(timeout=wait)
+                except queue.Empty:
+                    pass
+                else:
+                    remaining -= 1
+                    self._results.append(result)
+                    yield result
+                if timeout is None:
+                    continue
+
+                expired = []
+                now     = time.perf_counter()
+                with lock:
+                    for key, begun in list(running.items()):
+                        if now - begun >= timeout or now >= deadline:
+                            del running[key]
+                            expired.append(FanOutResult(targets[key], None,
+                                                        TimeoutError("Target timed out"), now - begun))
+                    if now >= deadline:
+                        late = TimeoutError("Target was not started in time")
+                        expired.extend([FanOutResult(target, None, late, 0.0) for key, target in queued])
+                        queued.clear()
+                    replace = min(len(expired), len(queued))
+                for _ in range(replace):
+                    threading.Thread(target=work, daemon=True).start()
+
+                for result in expired:
+                    remaining -= 1
+                    self._results.append(result)
+                    yield result
+        finally:
+            stop.set()
+            self._wall_time = time.perf_counter() - start
+
+    def run(self):
+        """
+        Runs every target and waits for them to finish or time out
+        :return:                       A list of FanOutResult tuples, in the order they finished
+        """
+
+        for result in self.results():
+            pass
+
+        return list(self._results)
+
+    def get_results(self):
+        """
+        Retrieves the results collected so far
+        :return:                       A list of FanOutResult tuples, in the order they finished
+        """
+
+        return list(self._results)
+
+    def get_wall_time(self):
+        """
+        Retrieves the time taken to run every target
+        :return:                       Seconds taken, or None if the targets have not been run
+        """
+
+        return self._wall_time
+
+    def summary(self):
+        """
+        Summarises the results as a table with one row per target, followed
+        by the total wall time and the target latencies
+        :return:                       The summary table text
+        """
+
+        rows   = [("TARGET", "STATUS", "LATENCY", "RESULT")]
+        failed = 0
+        for r in self._results:
+            if isinstance(r.error, TimeoutError):
+                status, value = "timeout", ""
+            elif r.error is not None:
+                status, value = "error", repr(r.error)
+            else:
+                status, value = "ok", "" if r.result is None else str(r.result)
+            failed += status != "ok"
+            rows.append((str(r.target), status, "%.1f ms" % (r.latency * 1000),
+                         value.replace("\n", " ")[:60]))
+
+        widths = [max([len(row[col]) for row in rows]) for col in range(3)]
+        lines  = ["  ".join([row[0].ljust(widths[0]), row[1].ljust(widths[1]),
+                             row[2].rjust(widths[2]), row[3]]).rstrip() for row in rows]
+
+        latencies = [r.latency for r in self._results]
+        lines.append("")
+        lines.append("%d targets, %d ok, %d failed, wall time %.3f s" % (
+            len(self._results), len(self._results) - failed, failed, self._wall_time or 0.0))
+        if latencies:
+            lines.append("latency min %.1f ms, mean %.1f ms, max %.1f ms" % (
+                min(latencies) * 1000, sum(latencies) / len(latencies) * 1000, max(latencies) * 1000))
+
+        return "\n".join(lines)
+
+def fan_out(option, targets, max_workers=FANOUT_WORKERS, timeout=None):
+    """
+    Runs an option function once per target concurrently and waits for
+    every target. See FanOut for streaming the results as they finish.
+    :param option:                     A MenuOption object, or the function to run
+    :param targets:                    An iterable of targets
+    :param max_workers:                The number of worker threads
+    :param timeout:                    Seconds a target may run before it is reported as timed out
+    :return:                           The FanOut object, holding the results and summary
+    """
+
+    fan = FanOut(option, targets, max_workers, timeout)
+    fan.run()
+
+    return fan
+
+class _Histogram(object):
+
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        """
+        Creates an empty latency histogram over METRIC_BUCKETS, with one
+        more bucket for values above the last bound
+        :return:                       A new _Histogram object
+        """
+
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def observe(self, seconds):
+        """
+        Adds a value to the histogram
+        :param seconds:                The value, in seconds
+        :return:                       Nothing
+        """
+
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def buckets(self):
+        """
+        Retrieves the cumulative bucket counts, ending with the +Inf bucket
+        :return:                       A list of (upper bound string, count) tuples
+        """
+
+        bounds = [repr(b) for b in METRIC_BUCKETS] + ["+Inf"]
+        return list(zip(bounds, itertools.accumulate(self.counts)))
+
+    def as_dict(self):
+        """
+        Retrieves the histogram for reporting
+        :return:                       A dictionary of the count, sum, max and
+                                       cumulative buckets, see buckets
+        """
+
+        return {"count": self.count, "sum": self.total, "max": self.max,
+                "buckets": dict(self.buckets())}
+
+class MenuMetrics(object):
+
+    def __init__(self):
+        """
+        Creates a collector of menu usage metrics. Once attached to menus it
+        counts selections and errors for each option, and keeps latency
+        histograms of the time spent waiting for input and rendering each
+        menu, and of the time spent in each option function. Metrics are kept
+        for each Menu object and reported under its name, which defaults to
+        the canonical path of the menu from the top of its tree, as named by
+        a SessionRecorder. Menus given the same name are told apart by a
+        "#2", "#3" and so on suffix.
+        :return:                       A new MenuMetrics object
+        """
+
+        self._lock   = threading.Lock()
+        self._names  = {}
+        self._menus  = {}
+        self._lazies = set()
+
+    def attach(self, menu, name=None, recursive=False):
+        """
+        Starts collecting metrics for a menu by adding hooks to it
+        :param menu:                   The Menu object to collect metrics for
+        :param name:                   The name the menu metrics are reported under,
+                                       defaults to the canonical path of the menu
+        :param recursive:              Also attaches every menu reachable from menu,
+                                       each named by its canonical path, and menus
+                                       built later by a LazyMenu among them
+        :raise MenuRuntimeError:       If menu is not a Menu object
+        :return:                       Nothing
+        """
+
+        if not isinstance(menu, Menu):
+            raise MenuRuntimeError("Metrics menu is not a Menu object")
+
+        top = menu
+        while top.get_parent_menu() is not None:
+            top = top.get_parent_menu()
+        paths = _menu_paths(top)
+
+        menus = list(_iter_menus(menu)) if recursive else [menu]
+        added = []
+        with self._lock:
+            for m in menus:
+                if m in self._names:
+                    continue
+                elif m in self._menus:
+                    self._names[m] = self._menus[m][0]
+                elif m in paths and not (m is menu and name):
+                    self._names[m] = self._take_over(m, top, paths)
+                else:
+                    default = paths.get(m, m.get_prompt())
+                    self._names[m] = self._unique_name(name if m is menu and name else default)
+                added.append(m)
+            if recursive:
+                _watch_builds(menus, self._on_build, self._lazies)
+
+        for m in added:
+            m.add_hook("post_render", self._on_render)
+            m.add_hook("post_selection", self._on_selection)
+            m.add_hook("post_dispatch", self._on_dispatch)
+
+    def detach(self, menu=None):
+        """
+        Stops collecting metrics for a menu. Metrics already collected are kept.
+        :param menu:                   The Menu object to detach, or None for every attached menu
+        :return:                       Nothing
+        """
+
+        if menu is None:
+            with self._lock:
+                _unwatch_builds(self._lazies, self._on_build)
+
+        for m in ([menu] if menu is not None else list(self._names)):
+            if self._names.pop(m, None) is not None:
+                m.remove_hook("post_render", self._on_render)
+                m.remove_hook("post_selection", self._on_selection)
+                m.remove_hook("post_dispatch", self._on_dispatch)
+
+    def reset(self):
+        """
+        Discards the metrics collected so far
+        :return:                       Nothing
+        """
+
+        with self._lock:
+            self._menus = {}
+
+    def as_dict(self):
+        """
+        Retrieves a snapshot of the metrics, keyed by menu name and then by
+        option id. Histograms hold a count, sum and max in seconds, and
+        cumulative bucket counts keyed by bucket upper bound.
+        :return:                       A dictionary of metrics
+        """
+
+        with self._lock:
+            return dict((name, {
+                "input_seconds":  stats["input"].as_dict(),
+                "render_seconds": stats["render"].as_dict(),
+                "options": dict((str(id), {"fx_seconds": hist.as_dict(), "errors": stats["errors"].get(id, 0)})
+                                for id, hist in stats["fx"].items()),
+            }) for name, stats in self._menus.values())
+
+    def to_json(self):
+        """
+        Retrieves a snapshot of the metrics as JSON
+        :return:                       A JSON string, see as_dict
+        """
+
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def to_prometheus(self, prefix="pymenu"):
+        """
+        Retrieves a snapshot of the metrics in the Prometheus text exposition format
+        :param prefix:                 The prefix for metric names
+        :return:                       The metrics text
+        """
+
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def histogram(lines, metric, labels, hist):
+            for bound, count in hist.buckets():
+                lines.append('%s_bucket{%sle="%s"} %d' % (metric, labels, bound, count))
+            lines.append("%s_sum{%s} %r" % (metric, labels.rstrip(","), hist.total))
+            lines.append("%s_count{%s} %d" % (metric, labels.rstrip(","), hist.count))
+
+        with self._lock:
+            menus = sorted(self._menus.values(), key=lambda entry: entry[0])
+            input_lines, render_lines, fx_lines, error_lines = [], [], [], []
+            for name, stats in menus:
+                labels = 'menu="%s",' % label(name)
+                histogram(input_lines, prefix + "_input_seconds", labels, stats["input"])
+                histogram(render_lines, prefix + "_render_seconds", labels, stats["render"])
+                for id, hist in stats["fx"].items():
+                    opt_labels = '%soption="%s",' % (labels, label(id))
+                    histogram(fx_lines, prefix + "_fx_seconds", opt_labels, hist)
+                    error_lines.append("%s_errors_total{%s} %d" % (
+                        prefix, opt_labels.rstrip(","), stats["errors"].get(id, 0)))
+
+        lines = []
+        for metric, kind, help, body in (
+                ("input_seconds", "histogram", "Time spent waiting for a selection", input_lines),
+                ("render_seconds", "histogram", "Time spent rendering a menu", render_lines),
+                ("fx_seconds", "histogram", "Time spent in an option function", fx_lines),
+                ("errors_total", "counter", "Option functions that raised an exception", error_lines)):
+            lines.append("# HELP %s_%s %s" % (prefix, metric, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, metric, kind))
+            lines.extend(body)
+
+        return "\n".join(lines) + "\n"
+
+    def _stats(self, menu):
+        """
+        Retrieves the metrics kept for a menu, creating them on first use.
+        The caller must hold the lock.
+        :param menu:                   An attached Menu object
+        :return:                       A dictionary of histograms and counters
+        """
+
+        entry = self._menus.get(menu)
+        if entry is None:
+            name = self._names.get(menu)
+            if name is None:
+                name = self._unique_name(menu.get_prompt())
+            entry = self._menus[menu] = (name, {"input": _Histogram(), "render": _Histogram(),
+                                                "fx": {}, "errors": {}})
+
+        return entry[1]
+
+    def _take_over(self, menu, top, paths):
+        """
+        Names a menu by its canonical path. A menu built again after its
+        LazyMenu was evicted from cache takes over the name and metrics of
+        the attached menu at that path, which still links to the tree but is
+        no longer in it. The caller must hold the lock.
+        :param menu:                   The Menu object to name
+        :param top:                    The top Menu object of the tree
+        :param paths:                  The canonical paths of the tree, see _menu_paths
+        :return:                       The name of the menu
+        """
+
+        name = paths[menu]
+        for old, old_name in list(self._names.items()):
+            if old_name != name or old in paths:
+                continue
+            old_top = old
+            while old_top.get_parent_menu() is not None:
+                old_top = old_top.get_parent_menu()
+            if old_top is top:
+                del self._names[old]
+                old.remove_hook("post_render", self._on_render)
+                old.remove_hook("post_selection", self._on_selection)
+                old.remove_hook("post_dispatch", self._on_dispatch)
+                if old in self._menus:
+                    self._menus[menu] = self._menus.pop(old)
+                return name
+
+        return self._unique_name(name)
+
+    def _unique_name(self, name):
+        """
+        Adds a suffix to a menu name already used by another menu.
+        The caller must hold the lock.
+        :param name:                   A menu name
+        :return:                       A name no other menu is reported under
+        """
+
+        taken  = set(self._names.values())
+        taken.update([entry[0] for entry in self._menus.values()])
+        unique = name
+        count  = 1
+        while unique in taken:
+            count += 1
+            unique = "%s#%d" % (name, count)
+
+        return unique
+
+    def _on_build(self, menu):
+        """
+        Attaches a menu built by a LazyMenu in a recursively attached tree
+        :param menu:                   The Menu object that was built
+        :return:                       Nothing
+        """
+
+        self.attach(menu, recursive=True)
+
+    def _on_render(self, menu, seconds):
+        """
+        Records the time taken to render a menu
+        :param menu:                   The Menu object rendered
+        :param seconds:                The seconds rendering took
+        :return:                       Nothing
+        """
+
+        with self._lock:
+            self._stats(menu)["render"].observe(seconds)
+
+    def _on_selection(self, menu, selection, seconds):
+        """
+        Records the time spent waiting for a selection
+        :param menu:                   The Menu object the selection was made in
+        :param selection:              The selection
+        :param seconds:                The seconds spent waiting for it
+        :return:                       Nothing
+        """
+
+        with self._lock:
+            self._stats(menu)["input"].observe(seconds)
+
+    def _on_dispatch(self, menu, opt, seconds, error):
+        """
+        Records the time taken by an option function and any error it raised
+        :param menu:                   The Menu object the option belongs to
+        :param opt:                    The MenuOption object that ran
+        :param seconds:                The seconds the option function took
+        :param error:                  The exception it raised, or None
+        :return:                       Nothing
+        """
+
+        with self._lock:
+            stats = self._stats(menu)
+            hist  = stats["fx"].get(opt.get_id())
+            if hist is None:
+                hist = stats["fx"][opt.get_id()] = _Histogram()
+            hist.observe(seconds)
+            if isinstance(error, Exception):
+                stats["errors"][opt.get_id()] = stats["errors"].get(opt.get_id(), 0) + 1
+
+def stub_menu(menu, stub=None):
+    """
+    Copies a menu tree, replacing every option function that does not
+    navigate between menus with a stub, so the tree can be driven without
+    side effects. Navigation options lead to the matching copied menus.
+    :param menu:                       The Menu object to copy, see compile_menu for the
+                                       menus that are copied with it
+    :param stub:                       The function to use, defaults to one returning None
+    :raise MenuCreateError:            If a menu has option sources
+    :return:                           The copy of menu
+    """
+
+    if stub is None:
+        stub = _stub
+    menus, index = _collect_menus(menu)
+
+    copies = [Menu(m.get_prompt(), m.get_level()) for m in menus]
+    for m, copy in zip(menus, copies):
+        opts = []
+        for opt in m.get_options():
+            fx     = opt.get_fx()
+            method = _menu_method(fx)
+            if method:
+                fx = getattr(copies[index[method[0]]], method[1])
+            elif fx is not None:
+                fx = stub
+            opts.append(MenuOption(opt.get_id(), opt.get_text(), opt.get_selectors(), fx))
+        copy.add_options(opts)
+        copy._child_menus = [copies[index[c]] for c in m.get_child_menus()]
+        if m.get_parent_menu() in index:
+            copy._parent_menu = copies[index[m.get_parent_menu()]]
+        if m._sel_trie:
+            copy.set_matching(m._prefix, m._fuzzy)
+
+    return copies[0]
+
+def _stub():
+    pass
+
+def _menu_paths(menu):
+    """
+    Names a menu and the menus below it by the canonical path leading to them
+    :param menu:                       The Menu object to start from, named ""
+    :return:                           A dictionary of Menu objects to paths
+    """
+
+    paths = {menu: ""}
+    for path, (menus, opt) in menu._get_path_index().items():
+        target = _nav_target(opt.get_fx())
+        if target is not None and target not in paths and target is not menus[-1].get_parent_menu():
+            paths[target] = path
+
+    return paths
+
+def _watch_builds(menus, fx, watched):
+    """
+    Adds a build hook to every LazyMenu used as an option function by the
+    given menus, so menus built later can be hooked as they are built
+    :param menus:                      An iterable of Menu objects
+    :param fx:                         The build hook, see LazyMenu.add_build_hook
+    :param watched:                    A set of the LazyMenu objects already given the
+                                       hook, updated in place
+    :return:                           Nothing
+    """
+
+    for menu in menus:
+        for opt in menu.get_options():
+            lazy = opt.get_fx()
+            if isinstance(lazy, LazyMenu) and lazy not in watched:
+                watched.add(lazy)
+                lazy.add_build_hook(fx)
+
+def _unwatch_builds(watched, fx):
+    """
+    Removes a build hook added by _watch_builds
+    :param watched:                    A set of the LazyMenu objects given the hook,
+                                       emptied in place
+    :param fx:                         The build hook
+    :return:                           Nothing
+    """
+
+    while watched:
+        watched.pop().remove_build_hook(fx)
+
+class SessionRecorder(object):
+
+    def __init__(self):
+        """
+        Creates a recorder of operator sessions. Once attached to a menu
+        tree it records, for each selection read from the operator, when it
+        was read, how long the operator took, the menu it was made in, and
+        the options it ran. Menus are named by their canonical path, and
+        menus built later by a LazyMenu in the tree are recorded as they are
+        built. Each MenuSession run on the tree gets its own transcript, so
+        one recorder can record the concurrent sessions of a MenuServer.
+        :return:                       A new SessionRecorder object
+        """
+
+        self._lock        = threading.Lock()
+        self._roots       = []
+        self._menus       = {}
+        self._lazies      = set()
+        self._transcripts = {}
+        self._start       = None
+
+    def attach(self, menu):
+        """
+        Starts recording the sessions run on a menu and the menus below it.
+        Attach the tree again after adding menus to it other than by a LazyMenu.
+        :param menu:                   The root Menu object of the tree
+        :raise MenuRuntimeError:       If menu is not a Menu object
+        :return:                       Nothing
+        """
+
+        if not isinstance(menu, Menu):
+            raise MenuRuntimeError("Recorder menu is not a Menu object")
+
+        with self._lock:
+            if menu not in self._roots:
+                self._roots.append(menu)
+            added = [(m, path) for m, path in _menu_paths(menu).items() if m not in self._menus]
+            self._menus.update(added)
+            _watch_builds(self._menus, self._on_build, self._lazies)
+
+        for m, path in added:
+            m.add_hook("post_selection", self._on_selection)
+            m.add_hook("post_dispatch", self._on_dispatch)
+
+    def detach(self):
+        """
+        Stops recording. The transcripts recorded so far are kept.
+        :return:                       Nothing
+        """
+
+        with self._lock:
+            menus, self._menus, self._roots = self._menus, {}, []
+            _unwatch_builds(self._lazies, self._on_build)
+
+        for m in menus:
+            m.remove_hook("post_selection", self._on_selection)
+            m.remove_hook("post_dispatch", self._on_dispatch)
+
+    def get_transcript(self):
+        """
+        Retrieves the transcript of the first session recorded. Each entry
+        is a dictionary with the seconds since recording started at which
+        the selection was read ("t"), the seconds spent waiting for it
+        ("wait"), the path of the menu it was made in ("menu"), the
+        selection itself ("selection"), the ids of the options it ran
+        ("options") and the seconds they took ("seconds").
+        :return:                       A list of transcript entries, empty if
+                                       nothing has been recorded
+        """
+
+        transcripts = self.get_transcripts()
+        return transcripts[0] if transcripts else []
+
+    def get_transcripts(self):
+        """
+        Retrieves the transcript of each session recorded, in the order the
+        sessions made their first selection, see get_transcript
+        :return:                       A list of transcripts
+        """
+
+        with self._lock:
+            return [[dict(entry) for entry in transcript] for transcript in self._transcripts.values()]
+
+    def save(self, path, index=0):
+        """
+        Writes the transcript of a recorded session to a JSON file
+        :param path:                   The path to the file
+        :param index:                  The position of the session in get_transcripts
+        :return:                       Nothing
+        """
+
+        transcripts = self.get_transcripts()
+        with open(path, "w") as f:
+            json.dump(transcripts[index] if transcripts else [], f)
+
+    def _on_build(self, menu):
+        """
+        Starts recording a menu built by a LazyMenu in an attached tree
+        :param menu:                   The Menu object that was built
+        :return:                       Nothing
+        """
+
+        for root in list(self._roots):
+            self.attach(root)
+
+    def _on_selection(self, menu, selection, seconds):
+        """
+        Starts a transcript entry for a selection read in the running session
+        :param menu:                   The Menu object the selection was made in
+        :param selection:              The selection
+        :param seconds:                The seconds spent waiting for it
+        :return:                       Nothing
+        """
+
+        now = time.perf_counter()
+        with self._lock:
+            if self._start is None:
+                self._start = now - seconds
+            transcript = self._transcripts.setdefault(_SESSION.get(), [])
+            transcript.append({"t": now - self._start, "wait": seconds,
+                               "menu": self._menus.get(menu, menu.get_prompt()),
+                               "selection": selection, "options": [], "seconds": 0.0})
+
+    def _on_dispatch(self, menu, opt, seconds, error):
+        """
+        Adds an option run to the last transcript entry of the running session
+        :param menu:                   The Menu object the option belongs to
+        :param opt:                    The MenuOption object that ran
+        :param seconds:                The seconds the option function took
+        :param error:                  The exception it raised, or None
+        :return:                       Nothing
+        """
+
+        with self._lock:
+            transcript = self._transcripts.get(_SESSION.get())
+            if transcript:
+                transcript[-1]["options"].append(opt.get_id())
+                transcript[-1]["seconds"] += seconds
+
+def load_transcript(path):
+    """
+    Reads a transcript written by SessionRecorder.save
+    :param path:                       The path to the file
+    :raise MenuRuntimeError:           If the file does not hold a transcript
+    :return:                           A list of transcript entries
+    """
+
+    with open(path) as f:
+        transcript = json.load(f)
+    if not isinstance(transcript, list) or [e for e in transcript if not isinstance(e, dict) or "selection" not in e]:
+        raise MenuRuntimeError("Transcript is not a list of selections")
+
+    return transcript
+
+class SessionReplay(object):
+
+    def __init__(self, menu, transcripts, sessions=None, speed=None, max_workers=REPLAY_WORKERS):
+        """
+        Replays recorded transcripts against a menu tree as concurrent
+        simulated sessions, each with its own MenuSession on the shared
+        tree. Each selection is compared with the transcript: the session
+        diverges at a step if it is in another menu than the one recorded
+        or runs other options. Use stub_menu to replay against a copy of a
+        tree whose option functions do nothing.
+        :param menu:                   The root Menu object to replay against
+        :param transcripts:            A list of transcripts, see SessionRecorder
+        :param sessions:               The number of sessions, each replaying the
+                                       transcripts in turn, defaults to one per transcript
+        :param speed:                  Replays the recorded waits between selections
+                                       this many times faster, or None for full speed
+        :param max_workers:            The number of sessions run at once
+        :raise MenuRuntimeError:       If menu is not a Menu object
+                                       If there are no transcripts
+                                       If sessions, speed or max_workers is not positive
+        :return:                       A new SessionReplay object
+        """
+
+        if not isinstance(menu, Menu):
+            raise MenuRuntimeError("Replay menu is not a Menu object")
+        elif not transcripts:
+            raise MenuRuntimeError("Replay has no transcripts")
+        elif sessions is not None and (not isinstance(sessions, int) or sessions < 1):
+            raise MenuRuntimeError("Replay sessions is not a positive integer")
+        elif speed is not None and (not isinstance(speed, (int, float)) or speed <= 0):
+            raise MenuRuntimeError("Replay speed is not a positive number")
+        elif not isinstance(max_workers, int) or max_workers < 1:
+            raise MenuRuntimeError("Replay workers is not a positive integer")
+
+        self._menu        = menu
+        self._transcripts = list(transcripts)
+        self._sessions    = sessions or len(self._transcripts)
+        self._speed       = speed
+        self._max_workers = max_workers
+        self._latencies   = []
+        self._divergences = []
+        self._wall_time   = None
+
+    def run(self):
+        """
+        Runs every session and waits for them to finish
+        :return:                       Nothing
+        """
+
+        paths = _menu_paths(self._menu)
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(min(self._max_workers, self._sessions)) as pool:
+            runs = [pool.submit(self._replay, idx, self._transcripts[idx % len(self._transcripts)], paths)
+                    for idx in range(self._sessions)]
+            latencies   = []
+            divergences = []
+            for run in runs:
+                session_latencies, session_divergences = run.result()
+                latencies.extend(session_latencies)
+                divergences.extend(session_divergences)
+        self._wall_time   = time.perf_counter() - start
+        self._latencies   = latencies
+        self._divergences = divergences
+
+    def get_divergences(self):
+        """
+        Retrieves the steps at which replayed sessions did not follow their transcripts
+        :return:                       A list of ReplayDivergence tuples, where expected and
+                                       actual are (menu path, option ids) tuples
+        """
+
+        return list(self._divergences)
+
+    def get_latency(self, percentile):
+        """
+        Retrieves a percentile of the time taken to run each replayed selection
+        :param percentile:             A percentile from 0 to 100
+        :return:                       The latency in seconds, or None if nothing was replayed
+        """
+
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100.0))]
+
+    def get_wall_time(self):
+        """
+        Retrieves the time taken to run every session
+        :return:                       The wall time in seconds, or None if the replay has not run
+        """
+
+        return self._wall_time
+
+    def as_dict(self):
+        """
+        Retrieves the replay results
+        :return:                       A dictionary of results
+        """
+
+        selections = len(self._latencies)
+        return {
+            "sessions":    self._sessions,
+            "selections":  selections,
+            "wall_time":   self._wall_time,
+            "throughput":  selections / self._wall_time if self._wall_time else None,
+            "latency":     dict(("p%d" % p, self.get_latency(p)) for p in (50, 90, 99, 100)),
+            "divergences": len(self._divergences),
+            "diverged_sessions": len(set(d.session for d in self._divergences)),
+        }
+
+    def summary(self):
+        """
+        Summarises the replay as text
+        :return:                       The summary text
+        """
+
+        result = self.as_dict()
+        lines  = ["%d sessions, %d selections in %.3f s, %.0f selections/s" % (
+            result["sessions"], result["selections"], result["wall_time"] or 0, result["throughput"] or 0)]
+        if result["selections"]:
+            lines.append("latency p50 %.3f ms, p90 %.3f ms, p99 %.3f ms, max %.3f ms" % tuple(
+                result["latency"][p] * 1000 for p in ("p50", "p90", "p99", "p100")))
+        lines.append("%d divergent steps in %d sessions" % (result["divergences"], result["diverged_sessions"]))
+        for d in self._divergences[:MATCH_CANDIDATES]:
+            lines.append("  session %d step %d %r: expected %s %s, got %s %s" % (
+                d.session, d.step, d.selection, d.expected[0] or "/", list(d.expected[1]),
+                d.actual[0] or "/", list(d.actual[1])))
+
+        return "\n".join(lines)
+
+    def _replay(self, idx, transcript, paths):
+        """
+        Replays one transcript in a new session
+        :param idx:                    The session number
+        :param transcript:             A list of transcript entries
+        :param paths:                  A dictionary of Menu objects to paths
+        :return:                       A tuple of a list of latencies and a list of
+                                       ReplayDivergence tuples
+        """
+
+        session     = MenuSession(self._menu)
+        latencies   = []
+        divergences = []
+        for step, entry in enumerate(transcript):
+            if self._speed and entry.get("wait"):
+                time.sleep(entry["wait"] / self._speed)
+
+            # Run as one batch line, so the selection is matched as the live session matched it
+            menu  = paths.get(session.get_menu(), session.get_menu().get_prompt())
+            start = time.perf_counter()
+            steps = session.run_batch([entry["selection"]], quiet=True)
+            latencies.append(time.perf_counter() - start)
+
+            options  = [s.option_id for s in steps if s.option_id is not None]
+            expected = (entry.get("menu", menu), tuple(entry.get("options", options)))
+            if (menu, tuple(options)) != expected:
+                divergences.append(ReplayDivergence(idx, step, entry["selection"], expected, (menu, tuple(options))))
+            if steps and isinstance(steps[-1].error, SystemExit):
+                break
+
+        return latencies, divergences
+
+def replay(menu, transcripts, sessions=None, speed=None, max_workers=REPLAY_WORKERS):
+    """
+    Replays recorded transcripts against a menu tree and waits for every
+    session. See SessionReplay.
+    :param menu:                       The root Menu object to replay against
+    :param transcripts:                A list of transcripts, see SessionRecorder
+    :param sessions:                   The number of sessions, defaults to one per transcript
+    :param speed:                      Replays the recorded waits this many times faster,
+                                       or None for full speed
+    :param max_workers:                The number of sessions run at once
+    :return:                           The SessionReplay object, holding the results and summary
+    """
+
+    replayer = SessionReplay(menu, transcripts, sessions, speed, max_workers)
+    replayer.run()
+
+    return replayer
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Lets the tests import pymenu.py from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
\ No newline at end of file
@@ -0,0 +1,120 @@
+import threading
+
+import pytest
+
+import pymenu
+
+THREADS = 8
+ROUNDS  = 300
+
+
+def build_tree():
+    """Builds a tree of plain and lazily built child menus, two of the lazy ones sharing a small cache"""
+
+    root  = pymenu.Menu(prompt="R>")
+    cache = pymenu.MenuCache(1)
+
+    def leaf(name):
+        def build():
+            menu = pymenu.Menu(prompt="%s>" % name, lvl=pymenu.MENU_ROOT + 1, add_back=True)
+            menu.add_option(1, "[x] run", ["x", "run"], lambda: name)
+            return menu
+        return build
+
+    plain = leaf("p")()
+    root.add_child_menu(plain)
+    root.add_option(1, "[p]lain", ["p", "plain"], plain.run)
+    root.add_option(2, "[l]azy", ["l", "lazy"], root.add_child_factory(leaf("l")))
+    root.add_option(3, "[c]ached", ["c", "cached"], root.add_child_factory(leaf("c"), cache))
+    root.add_option(4, "[d]ropped", ["d", "dropped"], root.add_child_factory(leaf("d"), cache))
+    root.add_option(5, "[r]oot", ["r"], lambda: "r")
+    return root
+
+
+def hammer(fx, threads=THREADS):
+    """Runs fx(thread number) in several threads at once and returns the exceptions they raised"""
+
+    errors  = []
+    barrier = threading.Barrier(threads)
+
+    def run(number):
+        barrier.wait()
+        try:
+            fx(number)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return errors
+
+
+def test_concurrent_dispatch_returns_each_option_result():
+    root  = build_tree()
+    paths = {"plain/run": "p", "lazy/run": "l", "cached/run": "c", "dropped/run": "d", "r": "r"}
+
+    def work(number):
+        for i in range(ROUNDS):
+            for path, expected in paths.items():
+                result = pymenu.dispatch(root, path)
+                assert result.result == expected, (path, result)
+            assert pymenu.dispatch(root, "c").menu.get_prompt() == "c>"
+
+    assert hammer(work) == []
+
+
+def test_concurrent_dispatch_while_the_tree_changes():
+    root  = build_tree()
+    spare = pymenu.Menu(prompt="S>")
+    spare.add_option(1, "[y] run", ["y"], lambda: "s")
+    done  = threading.Event()
+
+    def work(number):
+        if number == 0:
+            try:
+                for i in range(ROUNDS):
+                    root.add_option(10, "[s]pare", ["s", "spare"], spare.run)
+                    root.graft(spare)
+                    spare.detach()
+                    root.remove_option(10)
+            finally:
+                done.set()
+        else:
+            while not done.is_set():
+                assert pymenu.dispatch(root, "lazy/run").result == "l"
+                assert pymenu.dispatch(root, "cached/run").result == "c"
+                try:
+                    assert pymenu.dispatch(root, "spare/y").result == "s"
+                except pymenu.MenuOptionError:
+                    pass
+
+    assert hammer(work) == []
+
+    # Indexes rebuilt during the changes must still be dropped by later ones
+    root.add_option(10, "[s]pare", ["s", "spare"], spare.run)
+    assert pymenu.dispatch(root, "spare/y").result == "s"
+    spare.edit_option(1, selectors=["z"])
+    assert pymenu.dispatch(root, "spare/z").result == "s"
+    with pytest.raises(pymenu.MenuOptionError):
+        pymenu.dispatch(root, "spare/y")
+
+
+def test_concurrent_path_index_builds_register_every_user():
+    menus = [pymenu.Menu(prompt="T>") for i in range(THREADS)]
+    leaf  = pymenu.Menu(prompt="L>")
+    leaf.add_option(1, "[x] run", ["x"], lambda: "x")
+    for menu in menus:
+        menu.add_option(1, "[l]eaf", ["l", "leaf"], leaf.run)
+
+    for attempt in range(20):
+        leaf.edit_option(1, selectors=["x%d" % attempt])
+        errors = hammer(lambda number: menus[number].get_paths())
+        assert errors == []
+
+        # A change below must drop every index built through the leaf
+        leaf.edit_option(1, selectors=["y%d" % attempt])
+        for menu in menus:
+            assert pymenu.dispatch(menu, "leaf/y%d" % attempt).result == "x"
\ No newline at end of file
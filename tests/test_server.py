@@ -0,0 +1,159 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+import pymenu
+
+# A tree whose "e" menu is built lazily and has an option that cannot be imported
+SPEC = {"prompt": "R>", "options": [
+    {"id": 1, "text": "[l]ocation", "selectors": ["l"], "fx": "os.getcwd"},
+    {"id": 2, "text": "[e]rrors", "selectors": ["e"], "menu": {
+        "prompt": "E>", "back": True, "options": [
+            {"id": 1, "text": "[d]ead", "selectors": ["d"], "fx": "nomodule_xyz.func"}]}}]}
+
+
+def run_local(server, selections, timeout=10):
+    """
+    Runs one in-process connection in its own thread, failing if it does not
+    finish in time. A connection that spins without waiting for input never
+    gives the event loop a chance to cancel it, so it could not be timed out
+    from the loop itself.
+    """
+
+    if isinstance(server, pymenu.Menu):
+        server = pymenu.MenuServer(server)
+
+    done   = []
+    thread = threading.Thread(target=lambda: done.append(asyncio.run(server.run_local(selections))),
+                              daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert done, "connection did not finish"
+    return done[0]
+
+
+@pytest.fixture
+def tree():
+    root  = pymenu.Menu(prompt="R>")
+    child = pymenu.Menu(prompt="C>", lvl=pymenu.MENU_ROOT + 1, add_back=True)
+    empty = pymenu.Menu(prompt="X>")
+    child.add_option(1, "[k] ok", ["k"], lambda: "child ok")
+    root.add_child_menu(child)
+    root.add_child_menu(empty)
+    root.add_option(1, "[c]hild", ["c"], child.run)
+    root.add_option(2, "[x] empty", ["x"], empty.run)
+    root.add_option(3, "[f]ail", ["f"], lambda: 1 / 0)
+    root.add_option(4, "[k] ok", ["k"], lambda: "ok")
+    return root
+
+
+def test_session_runs_until_input_ends(tree):
+    out, stats = run_local(tree, ["c", "k", "b", "k"])
+
+    assert out.count("child ok") == 1
+    assert out.count("\nok\n") == 1
+    assert stats.get_inputs() == 4
+    assert stats.get_selections() == 4
+    assert stats.as_dict()["closed"] is not None
+
+
+def test_failing_option_is_reported_and_the_session_carries_on(tree):
+    out, stats = run_local(tree, ["f", "k", "f", "k"])
+
+    assert out.count("Error: division by zero") == 2
+    assert out.count("\nok\n") == 2
+    assert stats.get_inputs() == 4
+
+
+def test_empty_menu_returns_to_the_previous_menu(tree):
+    out, stats = run_local(tree, ["x", "k"])
+
+    assert "Error: Called menu has no options" in out
+    assert out.count("\nok\n") == 1
+    assert stats.get_inputs() == 2
+
+
+def test_empty_root_menu_closes_the_connection():
+    out, stats = run_local(pymenu.Menu(prompt="E>"), ["a", "b"])
+
+    assert out == "Error: Called menu has no options\n"
+    assert stats.get_inputs() == 0
+    assert stats.get_selections() == 0
+
+
+class FlakySource(pymenu.OptionSource):
+    """An option source that fails whenever it is read once it is down"""
+
+    def __init__(self):
+        self.down = False
+
+    def get_options(self):
+        if self.down:
+            raise RuntimeError("source is down")
+        return []
+
+    def get_version(self):
+        return self.get_options() and 0
+
+    def match(self, selection):
+        return None
+
+
+def test_menu_failing_before_input_returns_to_the_previous_menu(tree):
+    source = FlakySource()
+    broken = pymenu.Menu(prompt="S>")
+    broken.add_option_source(source)
+    tree.add_child_menu(broken)
+    tree.add_option(5, "[s]ource", ["s"], broken.run)
+    server = pymenu.MenuServer(tree)
+    source.down = True
+
+    out, stats = run_local(server, ["s", "k"])
+
+    assert "Error: source is down" in out
+    assert out.count("\nok\n") == 1
+    assert stats.get_inputs() == 2
+
+
+def test_failed_lazy_path_keeps_the_connection_open():
+    out, stats = run_local(pymenu.load_menu(SPEC), ["e/d", "l", "l"])
+
+    assert "Error: Option function nomodule_xyz.func cannot be imported" in out
+    assert out.count(os.getcwd()) == 2
+    assert stats.get_inputs() == 3
+    assert stats.get_selections() == 2
+
+
+def test_failed_lazy_menu_keeps_the_connection_open():
+    out, stats = run_local(pymenu.load_menu(SPEC), ["e", "l"])
+
+    assert "Error: Option function nomodule_xyz.func cannot be imported" in out
+    assert out.count(os.getcwd()) == 1
+    assert stats.get_inputs() == 2
+
+
+def test_chain_stopped_by_a_failed_path_reports_the_step():
+    out, stats = run_local(pymenu.load_menu(SPEC), ["l;e/d;l", "l"])
+
+    assert "Chain stopped at step 2 of 3 (e/d in R>)" in out
+    assert out.count(os.getcwd()) == 2
+    assert stats.get_inputs() == 2
+
+
+def test_connections_keep_their_own_sessions(tree):
+    server = pymenu.MenuServer(tree)
+
+    async def clients():
+        return await asyncio.gather(server.run_local(["c", "k"] * 20),
+                                    server.run_local(["k", "c", "b"] * 20))
+
+    (child_out, child_stats), (root_out, root_stats) = asyncio.run(clients())
+
+    assert child_out.count("child ok") == 20
+    assert root_out.count("\nok\n") == 20
+    assert "child ok" not in root_out
+    assert child_stats.get_inputs() == 40
+    assert root_stats.get_inputs() == 60
+    assert len(server.get_stats()) == 2
\ No newline at end of file
@@ -0,0 +1,104 @@
+import pytest
+
+import pymenu
+
+
+def chain(depth, prompt="M"):
+    """Builds a chain of menus, each the only child of the one before, and returns them top first"""
+
+    menus = [pymenu.Menu(prompt="%s0>" % prompt)]
+    for lvl in range(1, depth):
+        child = pymenu.Menu(prompt="%s%d>" % (prompt, lvl))
+        menus[-1].add_child_menu(child)
+        menus[-1].add_option(lvl, "[g]o %d" % lvl, ["g%d" % lvl], child.run)
+        menus.append(child)
+    return menus
+
+
+def levels(menus):
+    return [m.get_level() for m in menus]
+
+
+def test_graft_sets_levels_of_the_whole_subtree():
+    root = pymenu.Menu(prompt="R>")
+    sub  = chain(4, "S")
+
+    root.graft(sub[0])
+
+    assert sub[0].get_parent_menu() is root
+    assert sub[0] in root.get_child_menus()
+    assert levels(sub) == [pymenu.MENU_ROOT + 1 + i for i in range(4)]
+
+
+def test_detach_makes_the_subtree_a_root_tree():
+    menus = chain(5)
+
+    menus[2].detach()
+
+    assert menus[2].get_parent_menu() is None
+    assert menus[2] not in menus[1].get_child_menus()
+    assert levels(menus[:2]) == [pymenu.MENU_ROOT, pymenu.MENU_ROOT + 1]
+    assert levels(menus[2:]) == [pymenu.MENU_ROOT + i for i in range(3)]
+
+
+def test_detach_without_a_parent_fails():
+    with pytest.raises(pymenu.MenuEditError):
+        pymenu.Menu().detach()
+
+
+def test_move_updates_levels_and_paths():
+    menus = chain(4)
+    other = chain(2, "O")
+    assert menus[0].resolve_path("g1/g2/g3")[1] is not None
+
+    menus[2].move(other[1])
+
+    assert menus[2].get_parent_menu() is other[1]
+    assert menus[2] not in menus[1].get_child_menus()
+    assert levels(menus[2:]) == [other[1].get_level() + 1, other[1].get_level() + 2]
+    assert levels(menus[:2]) == [pymenu.MENU_ROOT, pymenu.MENU_ROOT + 1]
+    other[1].add_option(9, "[m]oved", ["m"], menus[2].run)
+    assert other[0].resolve_path("g1/m/g3")[1] is not None
+
+
+@pytest.mark.parametrize("below", [0, 1, 3])
+def test_move_below_itself_is_rejected_and_leaves_the_tree_unchanged(below):
+    menus  = chain(5)
+    before = levels(menus)
+
+    with pytest.raises(pymenu.MenuEditError):
+        menus[1].move(menus[1 + below])
+
+    assert levels(menus) == before
+    assert [m.get_parent_menu() for m in menus] == [None] + menus[:-1]
+
+
+def test_graft_rejects_cycles_and_parented_menus():
+    menus = chain(3)
+    top   = menus[0]
+
+    with pytest.raises(pymenu.MenuEditError):
+        menus[2].graft(top)
+    with pytest.raises(pymenu.MenuEditError):
+        top.graft(top)
+    with pytest.raises(pymenu.MenuEditError):
+        pymenu.Menu().graft(menus[1])
+    with pytest.raises(pymenu.MenuEditError):
+        top.graft("menu")
+
+    assert levels(menus) == [pymenu.MENU_ROOT + i for i in range(3)]
+
+
+def test_back_option_fails_after_detach_and_works_after_graft():
+    root  = pymenu.Menu(prompt="R>")
+    child = pymenu.Menu(prompt="C>", lvl=pymenu.MENU_ROOT + 1, add_back=True)
+    root.graft(child)
+    assert pymenu.dispatch(child, "b").menu is root
+
+    child.detach()
+    with pytest.raises(pymenu.MenuNavigateError):
+        pymenu.dispatch(child, "b")
+
+    other = pymenu.Menu(prompt="O>")
+    other.graft(child)
+    assert pymenu.dispatch(child, "b").menu is other
\ No newline at end of file